@@ -1,20 +1,63 @@
-import argparse
+import os
 import sys
+import hashlib
+import argparse
 '''
 Parse common arguments to many of these files.
 Each module has access to the command line arguments, so they will all see the same thing without
 explicitly passing stuff in
 '''
 
+# settings that change what a training run learns, for the default run id
+RUN_SETTINGS = ('experiment', 'batchsize', 'epochs', 'aug_mode', 'seed', 'pseudo', 'ema_decay', 'swa_start')
+
+def run_id(args):
+    '''
+    Id shared by all folds of a run: a hash of the script, its source and the RUN_SETTINGS,
+    so folds rerun with the same code and settings still match and anything else does not.
+    '''
+    script = sys.argv[0]
+    source = open(script, 'rb').read() if os.path.isfile(script) else ''
+    fields = [os.path.basename(script), hashlib.md5(source).hexdigest()]
+    fields += [(name, getattr(args, name)) for name in RUN_SETTINGS]
+    return hashlib.md5(repr(fields)).hexdigest()[:16]
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--label', type=str, default='', help='experiment label')
     parser.add_argument('-p', '--pixels', type=int, default=128, help='pixels')
     parser.add_argument('--batchsize', type=int, default=64)
     parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--valid_batchsize', type=int, default=0, help='validation batch size, 0 picks the largest that fits in memory')
     parser.add_argument('--fold', type=int, default=0)
+    parser.add_argument('--aug_mode', type=str, default='batch', choices=['batch', 'sample'],
+                        help='draw train augmentation params once per batch or once per sample')
+    parser.add_argument('--workers', type=int, default=2, help='augmentation worker processes, 0 augments in the training process')
+    parser.add_argument('--seed', type=int, default=0, help='seed for batch order and augmentation')
+    parser.add_argument('--tta_passes', type=int, default=20, help='test time augmentation passes')
+    parser.add_argument('--checkpoint_every', type=int, default=5, help='epochs between training checkpoints, 0 disables them')
+    parser.add_argument('--restart', action='store_true', help='start training from scratch instead of resuming from the last checkpoint')
+    parser.add_argument('--ema_decay', type=float, default=0., help='decay of a moving average of the weights saved as <label>_ema, 0 disables it')
+    parser.add_argument('--swa_start', type=int, default=0, help='first epoch averaged into the weights saved as <label>_swa, 0 disables it')
+    parser.add_argument('--no_compile_cache', action='store_true', help='always compile the theano functions instead of loading them from data/compiled')
+    parser.add_argument('--weights', type=str, default='last', choices=['best', 'last', 'ema', 'swa'],
+                        help='which saved weights of the run the prediction scripts load')
+    parser.add_argument('--fold_bn', action='store_true', help='fold BatchNorm into the convolutions before compiling the prediction function')
+    parser.add_argument('--fold_samples', type=int, default=256, help='test images the folded predictions are checked and timed on')
+    parser.add_argument('--fold_tolerance', type=float, default=1e-4, help='largest allowed difference of the folded probabilities')
+    parser.add_argument('--tta_mode', type=str, default='random', choices=['random', 'grid'],
+                        help='random crops per pass, or a fixed grid of crops from one padded batch')
+    parser.add_argument('--tta_grid', type=int, default=3, help='crop offsets per axis in grid TTA mode')
+    parser.add_argument('--tta_rotations', type=float, nargs='*', default=[], help='extra center crop rotations in degrees in grid TTA mode')
+    parser.add_argument('--pseudo', type=str, default='data/cache/pseudo_0175.npy',
+                        help='soft targets for pseudo labeling, a prediction store (.npz) or an old .npy')
+    parser.add_argument('--run_id', type=str, default='', help='id stamped on the out-of-fold predictions and training checkpoints, defaults to a hash of the script and settings')
+    parser.add_argument('--tta_checkpoint', action='store_true', help='save TTA statistics after every pass and resume from them')
 
     args, unknown_args = parser.parse_known_args()
+    # label shared by all folds of a run, e.g. for the out-of-fold predictions
+    args.experiment = args.label + '_%d'%args.pixels
+    args.run_id = args.run_id or run_id(args)
     args.label += '_%d_fold%02d'%(args.pixels, args.fold)
     #args.label += '_%d'%args.pixels
 
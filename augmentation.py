@@ -0,0 +1,233 @@
+import numpy as np
+
+'''
+Whole-batch data augmentation.
+
+The per-image, per-channel loop in utils (skimage warp, np.pad, crop) is replaced
+by a single sampling grid per batch. The rotation/shear/zoom affine and the reflect
+pad-and-crop are composed into one set of bilinear sample coordinates, and the whole
+(N, C, H, W) batch is gathered with one np.take. Intensity and brightness are then
+applied as broadcast ops.
+
+Augmentation parameters are arrays with a leading dimension of either 1 (one draw
+shared by the whole batch, the original behaviour) or N (an independent draw for
+every sample). Per-sample mode stacks the transforms into an (N, 3, 3) array, builds
+the N grids in float32 and mixes the four gathered neighbours of each channel with
+weighted adds, so it stays at least as fast as the per-image loop.
+'''
+
+AUG_MODES = ('batch', 'sample')
+
+def reflect_index(coords, dim):
+    '''
+    Mirror out-of-range integer coordinates back into [0, dim - 1] without repeating
+    the edge pixel. This is what both skimage's 'reflect' warp mode and
+    np.pad(mode='reflect') do, so it is used for the warp and the pad-crop alike.
+    '''
+    if dim == 1:
+        return np.zeros_like(coords)
+    cmax = dim - 1
+    coords = np.abs(coords)
+    if coords.max() > 2 * cmax:
+        # coordinates that wrap more than once, only hit with extreme zooms
+        wraps = coords // cmax
+        coords = coords % cmax
+        return np.where(wraps % 2 == 1, cmax - coords, coords)
+    return np.where(coords > cmax, 2 * cmax - coords, coords)
+
+def affine_matrix(pixels, zoom, shear_deg, rotate_deg):
+    '''
+    Build the (K, 3, 3) stack of tform_center + AffineTransform(shear, 1/zoom, rotation) + tform_uncenter,
+    the same transform utils used to construct with skimage for every batch.
+    zoom, shear_deg and rotate_deg are arrays of length K.
+    '''
+    shear = np.deg2rad(np.atleast_1d(shear_deg).astype(np.float64))
+    rotation = np.deg2rad(np.atleast_1d(rotate_deg).astype(np.float64))
+    scale = 1. / np.atleast_1d(zoom).astype(np.float64)
+
+    # have to shift to center and then shift back after transformation otherwise
+    # rotations will make image go out of frame
+    center_shift = pixels / 2. - 0.5
+    tform_center = np.array([[1., 0., -center_shift], [0., 1., -center_shift], [0., 0., 1.]])
+    tform_uncenter = np.array([[1., 0., center_shift], [0., 1., center_shift], [0., 0., 1.]])
+
+    tform_aug = np.zeros((scale.shape[0], 3, 3))
+    tform_aug[:, 0, 0] = scale * np.cos(rotation)
+    tform_aug[:, 0, 1] = -scale * np.sin(rotation + shear)
+    tform_aug[:, 1, 0] = scale * np.sin(rotation)
+    tform_aug[:, 1, 1] = scale * np.cos(rotation + shear)
+    tform_aug[:, 2, 2] = 1.
+
+    return np.einsum('ij,kjl,lm->kim', tform_uncenter, tform_aug, tform_center)
+
+def draw_params(pad_crop, n=1, rng=np.random):
+    '''
+    Draw n sets of augmentation parameters, with the same ranges utils.batch_iterator_train used.
+    n=1 gives one set shared by the whole batch.
+    '''
+    params = {}
+
+    # color intensity augmentation
+    params['intensity_channels'] = rng.randint(0, 2, size=(n, 3))
+    params['intensity'] = rng.randint(-20, 21, size=n)
+
+    # pad and crop settings
+    params['crop'] = rng.randint(0, (pad_crop*2) + 1, size=(n, 2))
+
+    # random zooms
+    params['zoom'] = rng.uniform(0.8, 1.2, size=n)
+
+    # shearing
+    params['shear'] = rng.uniform(-5, 5, size=n)
+
+    # random rotations betweein -15 and 15 degrees
+    params['rotate'] = rng.randint(-15, 16, size=n)
+
+    # brightness settings
+    params['bright'] = rng.uniform(0.9, 1.1, size=n)
+
+    return params
+
+class AugmentationEngine(object):
+    '''
+    Applies warp, pad-crop, channel intensity and brightness augmentations to a whole
+    (N, C, PIXELS, PIXELS) batch at once.
+
+    mode='batch' draws one set of parameters per batch, mode='sample' draws one per image.
+
+    The reflect index tables for every possible crop offset and the output pixel grid are
+    built once in the constructor, so per batch only the affine sample coordinates and
+    the gather remain.
+    '''
+    def __init__(self, pixels, pad_crop, mode='batch'):
+        if mode not in AUG_MODES:
+            raise ValueError('augmentation mode must be one of %s, got %s'%(AUG_MODES, mode))
+        self.pixels = pixels
+        self.pad_crop = pad_crop
+        self.mode = mode
+
+        # padded-and-cropped pixel i with crop offset t comes from warped pixel reflect(i + t - pad_crop)
+        offsets = np.arange(pixels)[None, :] + np.arange(2 * pad_crop + 1)[:, None] - pad_crop
+        self.crop_index = reflect_index(offsets, pixels)
+        # flat offsets of the top right, bottom left and bottom right neighbours from the top left
+        self.neighbours = np.array([0, 1, pixels, pixels + 1])
+
+    def params(self, n=1, rng=np.random):
+        if self.mode == 'batch':
+            n = 1
+        return draw_params(self.pad_crop, n, rng)
+
+    def sampling_grid(self, tform, crop, channels=1):
+        '''
+        Compose the crops (K, 2) and the affines (K, 3, 3) into bilinear sample points.
+        Returns the flat index (K, H*W) of the top left neighbour in the first channel of the
+        (K, channels, H*W) images, the other neighbours are self.neighbours further on, and
+        the four weights (K, H*W).
+        '''
+        pixels = self.pixels
+        n = crop.shape[0]
+        # one shared grid is cheap, per-sample grids are built in float32
+        dtype = np.float64 if n == 1 else np.float32
+        rows = self.crop_index[crop[:, 0]][:, :, None].astype(dtype)
+        cols = self.crop_index[crop[:, 1]][:, None, :].astype(dtype)
+        tform = tform.astype(dtype)[:, :, :, None, None]
+
+        # skimage maps output (row, col) to input (x=col, y=row) through the matrix
+        src_c = (tform[:, 0, 0] * cols + tform[:, 0, 1] * rows + tform[:, 0, 2]).reshape(n, -1)
+        src_r = (tform[:, 1, 0] * cols + tform[:, 1, 1] * rows + tform[:, 1, 2]).reshape(n, -1)
+
+        # linear interpolation is unchanged by reflecting about whole pixels, so reflecting the
+        # coordinates first keeps every neighbour inside the image without reflecting them
+        src_r = reflect_index(src_r, pixels)
+        src_c = reflect_index(src_c, pixels)
+        # the coordinates are positive, so truncating floors them. the last row and column
+        # interpolate from the one before with weight 1, where skimage's ceil has weight 0
+        min_r = np.minimum(src_r.astype(np.intp), pixels - 2)
+        min_c = np.minimum(src_c.astype(np.intp), pixels - 2)
+        dr = np.subtract(src_r, min_r, dtype=dtype).astype(np.float32, copy=False)
+        dc = np.subtract(src_c, min_c, dtype=dtype).astype(np.float32, copy=False)
+
+        index = min_r
+        index *= pixels
+        index += min_c
+        if n > 1:
+            index += (np.arange(n) * (channels * pixels * pixels))[:, None]
+
+        # (1 - dr) * (1 - dc), (1 - dr) * dc, dr * (1 - dc) and dr * dc
+        bottom_right = dr * dc
+        top_right = np.subtract(dc, bottom_right, out=dc)
+        bottom_left = np.subtract(dr, bottom_right, out=dr)
+        top_left = 1 - top_right
+        top_left -= bottom_left
+        top_left -= bottom_right
+
+        return index, [top_left, top_right, bottom_left, bottom_right]
+
+    def __call__(self, X_batch, params):
+        n, channels = X_batch.shape[:2]
+        index, weights = self.sampling_grid(affine_matrix(self.pixels, params['zoom'], params['shear'], params['rotate']),
+                                            params['crop'], channels)
+
+        if index.shape[0] == 1:
+            # one grid for the whole batch, one gather of (N*C, 4, H*W)
+            flat = X_batch.reshape(n * channels, -1)
+            gathered = np.take(flat, index + self.neighbours[:, None], axis=1)
+            X_batch_aug = np.einsum('nkp,kp->np', gathered, np.concatenate(weights)).astype(np.float32)
+        else:
+            # a grid per image, four gathers and weighted adds per channel. a neighbour or channel
+            # further on is the same gather from the flat batch shifted by its offset
+            flat = np.ascontiguousarray(X_batch, dtype=np.float32).reshape(-1)
+            plane_size = X_batch.shape[2] * X_batch.shape[3]
+            X_batch_aug = np.empty((n, channels, plane_size), dtype=np.float32)
+            for c in range(channels):
+                mixed = X_batch_aug[:, c]
+                np.multiply(np.take(flat[c * plane_size:], index), weights[0], out=mixed)
+                for offset, corner_weights in zip(self.neighbours[1:], weights[1:]):
+                    corner = np.take(flat[c * plane_size + offset:], index)
+                    corner *= corner_weights
+                    mixed += corner
+        X_batch_aug = X_batch_aug.reshape(X_batch.shape)
+
+        # color intensity then brightness
+        intensity = (params['intensity_channels'] * params['intensity'][:, None]).astype(np.float32)
+        X_batch_aug += intensity[:, :channels, None, None]
+        X_batch_aug *= params['bright'].astype(np.float32)[:, None, None, None]
+
+        return X_batch_aug
+
+    def augment(self, X_batch, rng=np.random):
+        return self(X_batch, self.params(X_batch.shape[0], rng))
+
+def augment_batch_loop(X_batch, params, pixels, pad_crop):
+    '''
+    Original per-image, per-channel augmentation from utils, kept as the reference
+    implementation for the benchmark and for checking AugmentationEngine output.
+    Takes per-batch (leading dimension 1) parameters.
+    '''
+    from skimage import transform
+
+    tform = affine_matrix(pixels, params['zoom'], params['shear'], params['rotate'])[0]
+    crop_x1 = params['crop'][0, 0]
+    crop_x2 = (pixels + crop_x1)
+    crop_y1 = params['crop'][0, 1]
+    crop_y2 = (pixels + crop_y1)
+
+    # set empty copy to hold augmented images so that we don't overwrite
+    X_batch_aug = np.copy(X_batch)
+
+    # for each image in the batch do the augmentation
+    for j in range(X_batch.shape[0]):
+        # for each image channel
+        for k in range(X_batch.shape[1]):
+            X_batch_aug[j,k] = transform._warps_cy._warp_fast(X_batch_aug[j,k], tform, output_shape=(pixels,pixels), mode='reflect')
+            # pad and crop images
+            img_pad = np.pad(X_batch_aug[j,k], pad_width=((pad_crop,pad_crop), (pad_crop,pad_crop)), mode='reflect')
+            X_batch_aug[j,k] = img_pad[crop_x1:crop_x2, crop_y1:crop_y2]
+
+            if params['intensity_channels'][0, k] == 1:
+                X_batch_aug[j][k] += params['intensity'][0]
+
+        # adjust brightness
+        X_batch_aug[j] = X_batch_aug[j] * params['bright'][0]
+
+    return X_batch_aug
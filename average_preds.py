@@ -1,72 +1,136 @@
+import glob
+import time
+import argparse
 import numpy as np
 import pandas as pd
 
-sub_1 = pd.read_csv('subm/GoogLeNet_224_fold00_finetune.csv')
-sub_2 = pd.read_csv('subm/GoogLeNet_224_fold01_finetune.csv')
-sub_3 = pd.read_csv('subm/GoogLeNet_224_fold02_finetune.csv')
-sub_4 = pd.read_csv('subm/GoogLeNet_224_fold03_finetune.csv')
-sub_5 = pd.read_csv('subm/GoogLeNet_224_fold04_finetune.csv')
-sub_6 = pd.read_csv('subm/GoogLeNet_224_fold05_finetune.csv')
-sub_7 = pd.read_csv('subm/GoogLeNet_224_fold06_finetune.csv')
-sub_8 = pd.read_csv('subm/GoogLeNet_224_fold07_finetune.csv')
-sub_9 = pd.read_csv('subm/GoogLeNet_224_fold08_finetune.csv')
-sub_10 = pd.read_csv('subm/GoogLeNet_224_fold09_finetune.csv')
-'''
-sub_11 = pd.read_csv('subm/resnet110_fullpre_11_tta.csv')
-sub_12 = pd.read_csv('subm/resnet110_fullpre_12_tta.csv')
-sub_13 = pd.read_csv('subm/resnet110_fullpre_13_tta.csv')
-sub_14 = pd.read_csv('subm/resnet110_fullpre_14_tta.csv')
-sub_15 = pd.read_csv('subm/resnet110_fullpre_15_tta.csv')
-sub_16 = pd.read_csv('subm/resnet110_fullpre_16_tta.csv')
-sub_17 = pd.read_csv('subm/resnet110_fullpre_17_tta.csv')
-sub_18 = pd.read_csv('subm/resnet110_fullpre_18_tta.csv')
-sub_19 = pd.read_csv('subm/resnet110_fullpre_19_tta.csv')
-#sub_20 = pd.read_csv('subm/20_tta.csv')
-'''
-#vgg_preds = pd.read_csv('subm/vgg_preds.csv', index_col=10)
-#vgg_aug = pd.read_csv('subm/pretrained_aug.csv', index_col=10)
-
-image_labels = sub_1['img']
-#image_reindex = sub_1['img'].as_matrix()
-
-sub_1 = sub_1.drop(['img'], axis=1)
-col_names = sub_1.columns.values
-sub_2 = sub_2.drop(['img'], axis=1)
-sub_3 = sub_3.drop(['img'], axis=1)
-sub_4 = sub_4.drop(['img'], axis=1)
-sub_5 = sub_5.drop(['img'], axis=1)
-sub_6 = sub_6.drop(['img'], axis=1)
-sub_7 = sub_7.drop(['img'], axis=1)
-sub_8 = sub_8.drop(['img'], axis=1)
-sub_9 = sub_9.drop(['img'], axis=1)
-sub_10 = sub_10.drop(['img'], axis=1)
-#vgg_preds = vgg_preds.set_index(['img'])
-
-#vgg_preds = vgg_preds.reindex(image_reindex)
-#vgg_aug = vgg_aug.reindex(image_reindex)
-
-#pseudo_labels_test = vgg_aug.values
-#np.save('data/pseudo_labels_test.npy', pseudo_labels_test)
+from predstore import load_predictions, save_predictions, write_submission
 
 '''
-sub_11 = sub_11.drop(['img'], axis=1)
-sub_12 = sub_12.drop(['img'], axis=1)
-sub_13 = sub_13.drop(['img'], axis=1)
-sub_14 = sub_14.drop(['img'], axis=1)
-sub_15 = sub_15.drop(['img'], axis=1)
-sub_16 = sub_16.drop(['img'], axis=1)
-sub_17 = sub_17.drop(['img'], axis=1)
-sub_18 = sub_18.drop(['img'], axis=1)
-sub_19 = sub_19.drop(['img'], axis=1)
-#sub_20 = sub_20.drop(['img'], axis=1)
+Average prediction files into one ensemble.
+
+Every input is a prediction store (.npz, see predstore) or a submission csv with an img
+column and one column per class. Rows are matched by img id rather than by position, and
+each file is read (csv in chunks) and added into a single (images, classes) accumulator,
+so hundreds of fold x TTA x model files can be combined in the memory of one submission.
+
+    python average_preds.py "data/preds/GoogLeNet_224_fold*_finetune.npz" --out subm/GoogleNet_finetune_ensemble.csv
+    python average_preds.py --manifest ensemble.txt --mean geometric --out data/preds/pseudo_ensemble.npz
+
+A manifest lists one file or glob per line, optionally followed by its weight; lines
+starting with # are skipped. Weights only matter for the weighted and geometric means.
+An --out ending in .npz writes a store, e.g. soft targets for pseudo labeling, anything
+else the final submission csv.
 '''
 
-combo = (sub_1.values + sub_2.values + sub_3.values + sub_4.values + sub_5.values + sub_6.values + sub_7.values + sub_8.values + sub_9.values + sub_10.values) / 10.0
+MEANS = ('arithmetic', 'geometric', 'weighted')
+
+# floor for log(p) in the geometric mean
+EPS = 1e-15
+
+def expand_inputs(patterns=(), manifest=None):
+    '''
+    List of (filename, weight) from globs and manifest lines, in the order given.
+    '''
+    entries = [(pattern, 1.) for pattern in patterns]
+    if manifest is not None:
+        with open(manifest) as f:
+            for line in f:
+                fields = line.split('#')[0].split()
+                if fields:
+                    entries.append((fields[0], float(fields[1]) if len(fields) > 1 else 1.))
+
+    inputs = []
+    for pattern, weight in entries:
+        files = sorted(glob.glob(pattern))
+        if not files:
+            raise ValueError('no prediction files match %s'%pattern)
+        inputs.extend((fl, weight) for fl in files)
+    return inputs
+
+def read_ids_columns(filename):
+    '''
+    img ids and class columns of a store or csv, without reading the predictions of a csv.
+    '''
+    if filename.endswith('.npz'):
+        _, ids, columns = load_predictions(filename)
+        return pd.Index(ids), columns
+    columns = [c for c in pd.read_csv(filename, nrows=0).columns if c != 'img']
+    return pd.Index(pd.read_csv(filename, usecols=['img'])['img']), columns
+
+def read_chunks(filename, columns, chunksize=10000):
+    '''
+    Yield (img ids, float64 predictions in the order of columns) of a store in one piece
+    or of a csv chunksize rows at a time. Columns are matched by name.
+    '''
+    if filename.endswith('.npz'):
+        predictions, ids, store_columns = load_predictions(filename)
+        yield ids, predictions[:, [store_columns.index(c) for c in columns]].astype(np.float64)
+    else:
+        for chunk in pd.read_csv(filename, chunksize=chunksize):
+            yield chunk['img'].values, chunk[columns].values.astype(np.float64)
+
+def average_predictions(inputs, mean='arithmetic', chunksize=10000):
+    '''
+    Mean of the predictions in inputs, a list of (filename, weight), aligned by img id.
+    Returns the ids and class columns of the first file and the (images, classes) mean.
+    Every file must have the same ids, each once, and class columns, in any order.
+    '''
+    if mean not in MEANS:
+        raise ValueError('mean must be one of %s, got %s'%(MEANS, mean))
+
+    ids, columns = read_ids_columns(inputs[0][0])
+    if not ids.is_unique:
+        raise ValueError('%s has duplicate img ids'%inputs[0][0])
+
+    total = np.zeros((len(ids), len(columns)), dtype=np.float64)
+    total_weight = 0.
+    for count, (fl, weight) in enumerate(inputs):
+        start = time.time()
+        if mean == 'arithmetic':
+            weight = 1.
+        seen = np.zeros(len(ids), dtype=bool)
+
+        for chunk_ids, preds in read_chunks(fl, columns, chunksize):
+            rows = ids.get_indexer(chunk_ids)
+            if (rows < 0).any():
+                raise ValueError('%s has img ids not in %s, e.g. %s'%(fl, inputs[0][0], chunk_ids[rows < 0][0]))
+            # a repeated id would only be added once by total[rows] +=, within a chunk or across chunks
+            repeated = seen[rows] | pd.Index(rows).duplicated()
+            if repeated.any():
+                raise ValueError('%s has duplicate img ids, e.g. %s'%(fl, chunk_ids[repeated][0]))
+            if mean == 'geometric':
+                preds = np.log(np.clip(preds, EPS, 1.))
+            total[rows] += weight * preds
+            seen[rows] = True
+
+        if not seen.all():
+            raise ValueError('%s is missing %d img ids, e.g. %s'%(fl, (~seen).sum(), ids[~seen][0]))
+        total_weight += weight
+        print('%d of %d: %s (weight %g) in %.1fs'%(count + 1, len(inputs), fl, weight, time.time() - start))
+
+    avg = total / total_weight
+    if mean == 'geometric':
+        avg = np.exp(avg)
+        avg /= avg.sum(axis=1, keepdims=True)
+    return ids, columns, avg
 
-#print combo.shape
-#np.save('data/cache/pseudo_labels_test.npy', combo)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='average prediction files by img id')
+    parser.add_argument('files', type=str, nargs='*', help='prediction stores, csv files or globs, defaults to the GoogLeNet finetune folds')
+    parser.add_argument('--manifest', type=str, default=None, help='file listing prediction files or globs and optional weights')
+    parser.add_argument('--mean', type=str, default='arithmetic', choices=MEANS, help='how to combine the predictions')
+    parser.add_argument('--chunksize', type=int, default=10000, help='csv rows read at a time')
+    parser.add_argument('--out', type=str, default='subm/GoogleNet_finetune_ensemble.csv', help='ensemble submission csv or .npz store')
+    args = parser.parse_args()
 
-#vgg_resnet = (combo + (vgg_aug.values * 3.0)) / 4.0
+    files = args.files
+    if not files and args.manifest is None:
+        files = ['data/preds/GoogLeNet_224_fold*_finetune.npz']
+    ids, columns, avg = average_predictions(expand_inputs(files, args.manifest), args.mean, args.chunksize)
 
-avg = pd.DataFrame(combo, index=image_labels, columns=col_names)
-avg.to_csv('subm/GoogleNet_finetune_ensemble.csv', index_label='img')
+    if args.out.endswith('.npz'):
+        save_predictions(args.out, avg, ids, columns, dtype=np.float32)
+    else:
+        write_submission(args.out, avg, ids, columns)
+    print('Wrote %s: %d images, %d classes'%(args.out, avg.shape[0], avg.shape[1]))
@@ -0,0 +1,43 @@
+import time
+import argparse
+import numpy as np
+
+from augmentation import AugmentationEngine, augment_batch_loop
+
+'''
+Micro-benchmark of the whole-batch augmentation engine against the original
+per-image, per-channel skimage loop. Reports images per second at each pixel size
+and the max absolute difference between the two outputs for the same parameters,
+plus the throughput of per-sample parameter draws on the same batches.
+'''
+
+def images_per_second(fn, X_batch, params, iters):
+    fn(X_batch, params[0])
+    start = time.time()
+    for i in range(iters):
+        fn(X_batch, params[i])
+    return (iters * X_batch.shape[0]) / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batchsize', type=int, default=64)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--pixels', type=int, nargs='+', default=[64, 128, 224])
+    args = parser.parse_args()
+
+    for pixels in args.pixels:
+        pad_crop = int(pixels * 0.21875)
+        engine = AugmentationEngine(pixels, pad_crop, mode='batch')
+        engine_sample = AugmentationEngine(pixels, pad_crop, mode='sample')
+        X_batch = (np.random.rand(args.batchsize, 3, pixels, pixels) * 255. - 128.).astype(np.float32)
+        params = [engine.params() for _ in range(args.iters)]
+        params_sample = [engine_sample.params(args.batchsize) for _ in range(args.iters)]
+
+        loop = lambda X, p: augment_batch_loop(X, p, pixels, pad_crop)
+        loop_ips = images_per_second(loop, X_batch, params, args.iters)
+        engine_ips = images_per_second(engine, X_batch, params, args.iters)
+        sample_ips = images_per_second(engine_sample, X_batch, params_sample, args.iters)
+        max_diff = np.amax(np.abs(engine(X_batch, params[0]) - loop(X_batch, params[0])))
+
+        print('pixels: %d | loop: %.1f img/s | engine: %.1f img/s | per-sample: %.1f img/s | speedup: %.1fx, per-sample %.1fx | max diff: %.2e'%(
+              pixels, loop_ips, engine_ips, sample_ips, engine_ips / loop_ips, sample_ips / loop_ips, max_diff))
@@ -0,0 +1,217 @@
+import sys
+import time
+import argparse
+import numpy as np
+
+import theano
+from theano import tensor as T
+import lasagne
+from lasagne.layers import helper, BatchNormLayer, NonlinearityLayer, DropoutLayer, DenseLayer
+from lasagne.layers.conv import BaseConvLayer
+from lasagne.nonlinearities import identity
+
+'''
+BatchNorm folding for inference-only networks.
+
+With deterministic=True a BatchNormLayer is a fixed per-channel affine map,
+(x - mean) * gamma * inv_std + beta, so when it directly follows a convolution or dense
+layer with no nonlinearity of its own (batch_norm(ConvLayer(...)), bn_conv in the
+Inception v3 builder, build_simple_block of the Caffe ResNet-50) it can be folded into that
+layer's weights and bias:
+
+    W' = W * gamma * inv_std (per output channel)    b' = (b - mean) * gamma * inv_std + beta
+
+A NonlinearityLayer following the BatchNormLayer moves into the folded layer, and dropout,
+the identity at inference, is dropped. BatchNormLayers that follow a sum or a pooling layer,
+like the pre-activation ones of the FullPre ResNets, stay as they are.
+
+fold_batchnorm rewires the network in place, so the trained weights have to be loaded before
+and the functions compiled after it. The submission scripts fold with --fold_bn and first
+check the folded network's predictions on --fold_samples test images against the original's,
+aborting above --fold_tolerance. Check a folded network and time it on its own:
+
+    python bnfold.py ResNet_FullPre_Wide --model_args n=2 k=3 -l ResNet_wide -p 128 --fold 0
+'''
+
+def input_layers(layer):
+    if hasattr(layer, 'input_layers'):
+        return layer.input_layers
+    if getattr(layer, 'input_layer', None) is not None:
+        return [layer.input_layer]
+    return []
+
+def consumers(output_layer):
+    '''
+    Dict of layer to the layers that take it as input.
+    '''
+    layers = helper.get_all_layers(output_layer)
+    users = dict((l, []) for l in layers)
+    for l in layers:
+        for incoming in input_layers(l):
+            users[incoming].append(l)
+    return users
+
+def bypass(layer, replacement, users, output_layer):
+    '''
+    Make every consumer of layer take replacement instead. Returns the new output layer.
+    '''
+    for user in users[layer]:
+        if hasattr(user, 'input_layers'):
+            user.input_layers = [replacement if l is layer else l for l in user.input_layers]
+        else:
+            user.input_layer = replacement
+    return replacement if output_layer is layer else output_layer
+
+def foldable(layer, users):
+    '''
+    Conv or dense layer without nonlinearity whose only consumer is a BatchNormLayer over its channels.
+    '''
+    if not isinstance(layer, (BaseConvLayer, DenseLayer)) or layer.nonlinearity is not identity:
+        return False
+    if len(users[layer]) != 1 or not isinstance(users[layer][0], BatchNormLayer):
+        return False
+    channels = layer.num_units if isinstance(layer, DenseLayer) else layer.num_filters
+    return users[layer][0].mean.get_value(borrow=True).shape == (channels,)
+
+def fold_layer(layer, bn):
+    '''
+    Fold the current values of bn's params into layer's W and b.
+    '''
+    mean = bn.mean.get_value()
+    scale = bn.inv_std.get_value()
+    if bn.gamma is not None:
+        scale = scale * bn.gamma.get_value()
+    shift = -mean * scale
+    if bn.beta is not None:
+        shift = shift + bn.beta.get_value()
+
+    W = layer.W.get_value()
+    if isinstance(layer, DenseLayer):
+        # dense W is (inputs, units)
+        layer.W.set_value((W * scale[np.newaxis, :]).astype(W.dtype))
+    else:
+        layer.W.set_value((W * scale.reshape((-1,) + (1,) * (W.ndim - 1))).astype(W.dtype))
+
+    if layer.b is None:
+        if getattr(layer, 'untied_biases', False):
+            b_shape = (layer.num_filters,) + tuple(layer.output_shape[2:])
+        else:
+            b_shape = (len(scale),)
+        layer.b = layer.add_param(lasagne.init.Constant(0.), b_shape, name='b', regularizable=False)
+    b = layer.b.get_value()
+    channel = (-1,) + (1,) * (b.ndim - 1)
+    layer.b.set_value((b * scale.reshape(channel) + shift.reshape(channel)).astype(b.dtype))
+
+def fold_batchnorm(output_layer):
+    '''
+    Fold every BatchNormLayer that follows a conv or dense layer into it and drop dropout,
+    in place. Returns the new output layer and a dict counting folded and kept BatchNormLayers
+    and removed DropoutLayers.
+    '''
+    report = {'folded': 0, 'kept': 0, 'dropout': 0}
+    changed = True
+    while changed:
+        changed = False
+        users = consumers(output_layer)
+        for layer in helper.get_all_layers(output_layer):
+            if isinstance(layer, DropoutLayer):
+                output_layer = bypass(layer, layer.input_layer, users, output_layer)
+                report['dropout'] += 1
+                changed = True
+                break
+            if foldable(layer, users):
+                bn = users[layer][0]
+                fold_layer(layer, bn)
+                replaced = bn
+                if len(users[bn]) == 1 and isinstance(users[bn][0], NonlinearityLayer):
+                    # the nonlinearity after the BN moves into the folded layer
+                    replaced = users[bn][0]
+                    layer.nonlinearity = replaced.nonlinearity
+                output_layer = bypass(replaced, layer, users, output_layer)
+                report['folded'] += 1
+                changed = True
+                break
+
+    report['kept'] = sum(isinstance(l, BatchNormLayer) for l in helper.get_all_layers(output_layer))
+    return output_layer, report
+
+def timed_predictions(fn, data, batchsize, repeats=3):
+    '''
+    Predictions of fn over data in batches and the best of repeats timings of a pass.
+    '''
+    batches = [data[i:i + batchsize] for i in range(0, data.shape[0], batchsize)]
+    predictions = np.concatenate([fn(X_batch) for X_batch in batches])
+
+    best = np.inf
+    for _ in range(repeats):
+        start = time.time()
+        for X_batch in batches:
+            fn(X_batch)
+        best = min(best, time.time() - start)
+    return predictions, best
+
+def compare_predictions(predict_original, predict_folded, data, batchsize, repeats=3):
+    '''
+    Max absolute difference of the two functions' outputs over data and the best of repeats
+    timings of a pass over data with each.
+    '''
+    original, original_time = timed_predictions(predict_original, data, batchsize, repeats)
+    folded, folded_time = timed_predictions(predict_folded, data, batchsize, repeats)
+    return np.abs(original - folded).max(), original_time, folded_time
+
+def reference_predictions(output_layer, input_var, data, batchsize):
+    '''
+    Predictions of the network on data and the time of a pass, to check the folded network against.
+    Call it before fold_batchnorm, which changes the params.
+    '''
+    predict_original = theano.function([input_var], lasagne.layers.get_output(output_layer, deterministic=True))
+    return timed_predictions(predict_original, data, batchsize)
+
+def check_folded(predict_folded, data, batchsize, reference, tolerance):
+    '''
+    Compare predict_folded on data with the reference predictions of the original network and
+    print the difference and the speedup. Raises ValueError if they differ by more than tolerance.
+    '''
+    original, original_time = reference
+    folded, folded_time = timed_predictions(predict_folded, data, batchsize)
+    max_diff = np.abs(original - folded).max()
+    print('Folded network: max probability difference %.2e | original %.2fs, folded %.2fs for %d images | speedup %.2fx'%(
+          max_diff, original_time, folded_time, data.shape[0], original_time / folded_time))
+    if not max_diff <= tolerance:
+        raise ValueError('folded predictions differ by %.2e, more than the tolerance %.2e'%(max_diff, tolerance))
+    return max_diff
+
+if __name__ == '__main__':
+    import models
+    import argparsing
+    from utils import load_test
+    from weightstore import load_params, weights_filename
+
+    parser = argparse.ArgumentParser(description='fold BatchNorm into a trained network, check and time it')
+    parser.add_argument('model', type=str, help='network builder in models.py')
+    parser.add_argument('--model_args', type=str, nargs='*', default=[], help='integer builder arguments, e.g. n=2 k=3')
+    fold_args, _ = parser.parse_known_args()
+    args, _ = argparsing.parse_args()
+
+    build = getattr(models, fold_args.model)
+    model_args = dict((k, int(v)) for k, v in (a.split('=') for a in fold_args.model_args))
+    weights = weights_filename(args.label, args.weights)
+
+    predict = []
+    for fold in (False, True):
+        X = T.tensor4('X')
+        output_layer = build(X, pixels=args.pixels, **model_args)
+        load_params(output_layer, weights)
+        if fold:
+            output_layer, report = fold_batchnorm(output_layer)
+            print('Folded %(folded)d BatchNormLayers, kept %(kept)d, removed %(dropout)d DropoutLayers'%report)
+        start = time.time()
+        predict.append(theano.function([X], lasagne.layers.get_output(output_layer, deterministic=True)))
+        print('%s compiled in %.1fs'%('folded' if fold else 'original', time.time() - start))
+
+    X_test, _ = load_test(args.pixels, cache=True)
+    max_diff, original_time, folded_time = compare_predictions(predict[0], predict[1], X_test[:args.fold_samples], args.batchsize)
+    print('Max probability difference %.2e | original %.2fs, folded %.2fs for %d images | speedup %.2fx'%(
+          max_diff, original_time, folded_time, min(args.fold_samples, X_test.shape[0]), original_time / folded_time))
+    if not max_diff <= args.fold_tolerance:
+        sys.exit('folded predictions differ by %.2e, more than the tolerance %.2e'%(max_diff, args.fold_tolerance))
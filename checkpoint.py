@@ -0,0 +1,98 @@
+import os
+import gzip
+import time
+import random
+import threading
+import cPickle as pickle
+import numpy as np
+
+import theano
+
+'''
+Training checkpoints.
+
+A checkpoint holds the value of every shared variable the training function reads or
+updates (the network parameters, the Adam or momentum state, the learning rate l_r and
+any random streams), the next epoch, the numpy and python random states and whatever
+history the script passes in (losses, best weights). The values are copied off the
+device in the training loop and then compressed and written in a background thread, so
+training only waits for the copy. Writes go to a temporary file that is renamed over the
+previous checkpoint, so a crash mid-write keeps the last good one.
+
+The checkpoint also records the run id of the settings it was trained with, and load refuses
+to resume a run with other settings under the same label.
+'''
+
+CHECKPOINT_DIR = os.path.join('data', 'checkpoints')
+
+def shared_state(fn):
+    '''
+    Every shared variable the compiled function fn reads or updates, in a fixed order.
+    '''
+    return [i.variable for i in fn.maker.inputs if isinstance(i.variable, theano.compile.SharedVariable)]
+
+class Checkpointer(object):
+    def __init__(self, label, fn, run_id=None):
+        self.filename = os.path.join(CHECKPOINT_DIR, '%s.pklz'%label)
+        self.state = shared_state(fn)
+        self.run_id = run_id
+        self.thread = None
+
+    def save(self, epoch, **history):
+        '''
+        Snapshot the training state before epoch, then write it in the background.
+        '''
+        checkpoint = {'epoch': epoch,
+                      'run_id': self.run_id,
+                      'state': [v.get_value() for v in self.state],
+                      'np_random': np.random.get_state(),
+                      'random': random.getstate(),
+                      'history': history}
+        # one write at a time, the previous one is usually long done
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(checkpoint,))
+        self.thread.start()
+
+    def _write(self, checkpoint):
+        start = time.time()
+        if not os.path.isdir(CHECKPOINT_DIR):
+            os.makedirs(CHECKPOINT_DIR)
+        tmp_filename = self.filename + '.tmp'
+        with gzip.open(tmp_filename, 'wb', compresslevel=1) as f:
+            pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, self.filename)
+        print('checkpoint: epoch %d saved to %s in %.1fs'%(checkpoint['epoch'], self.filename, time.time() - start))
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def load(self):
+        '''
+        Restore the last checkpoint into the shared variables and random states.
+        Returns its epoch and history, or None if there is none.
+        '''
+        if not os.path.isfile(self.filename):
+            return None
+        with gzip.open(self.filename, 'rb') as f:
+            checkpoint = pickle.load(f)
+
+        if checkpoint.get('run_id') != self.run_id:
+            raise ValueError('%s is from run %s, not %s; pass --restart to start this run from scratch'%(
+                             self.filename, checkpoint.get('run_id'), self.run_id))
+        if len(checkpoint['state']) != len(self.state) or \
+                any(value.shape != v.get_value(borrow=True).shape for value, v in zip(checkpoint['state'], self.state)):
+            raise ValueError('%s does not match the shared variables of this training function'%self.filename)
+        for value, v in zip(checkpoint['state'], self.state):
+            v.set_value(value)
+        np.random.set_state(checkpoint['np_random'])
+        random.setstate(checkpoint['random'])
+
+        print('checkpoint: resuming from %s at epoch %d'%(self.filename, checkpoint['epoch']))
+        return checkpoint['epoch'], checkpoint['history']
+
+    def remove(self):
+        self.wait()
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
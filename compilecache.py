@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import inspect
+import hashlib
+import cPickle as pickle
+import numpy as np
+
+import theano
+from lasagne.layers import helper
+
+'''
+On-disk cache of compiled Theano functions.
+
+Building the graph and calling theano.function optimizes the whole graph again in every
+process, which takes minutes for the deep ResNets and Inception v3. compiled_functions
+pickles the network together with the functions a script compiled for it, keyed on the
+network itself (every layer's class, settings, inputs, output shape and params), the
+source of the function that compiles it and the loss, and later runs (other folds, the
+submission scripts, the pseudo label cascade) unpickle them without re-optimizing.
+Networks built inside a script, like the Caffe ResNet-50, are covered the same way as
+the builders in models.py.
+
+The network and its functions go into one pickle so the functions keep updating the
+network's own shared variables. On a cache hit the parameter values of the freshly built
+network (new random init or pretrained weights) are copied into the cached one, so every
+fold still starts from its own initialization.
+'''
+
+CACHE_DIR = os.path.join('data', 'compiled')
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def describe(value):
+    '''
+    Stable description of a layer attribute: functions by name, objects like LeakyRectify by class and settings.
+    '''
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (int, long, float, bool, basestring, type(None))):
+        return value
+    if isinstance(value, (tuple, list)):
+        return tuple(describe(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, describe(v)) for k, v in value.items()))
+    if hasattr(value, 'get_value') or hasattr(value, 'owner'):
+        # shared and symbolic variables are covered by the params and the graph
+        return type(value).__name__
+    if callable(value) and hasattr(value, '__name__'):
+        return '%s.%s'%(getattr(value, '__module__', ''), value.__name__)
+    attributes = getattr(value, '__dict__', {})
+    return (type(value).__name__, tuple(sorted((k, describe(v)) for k, v in attributes.items()
+                                               if isinstance(v, (int, long, float, bool, basestring, type(None))))))
+
+def network_signature(output_layer):
+    '''
+    Hash of the structure of a network: per layer its class, simple settings (nonlinearity, pool
+    mode, dropout p, stride, ...), the indices of its input layers, its output shape and the names,
+    shapes and tags of its params.
+    '''
+    layers = helper.get_all_layers(output_layer)
+    index = dict((id(l), i) for i, l in enumerate(layers))
+    description = []
+    for layer in layers:
+        inputs = getattr(layer, 'input_layers', None) or [getattr(layer, 'input_layer', None)]
+        settings = sorted((k, describe(v)) for k, v in vars(layer).items()
+                          if k not in ('input_layer', 'input_layers', 'input_shape', 'input_shapes', 'params', 'name'))
+        params = [(p.name, p.get_value(borrow=True).shape, sorted(tags)) for p, tags in layer.params.items()]
+        description.append((type(layer).__name__, [index.get(id(l)) for l in inputs if l is not None],
+                            layer.output_shape, settings, params))
+    return hashlib.sha1(repr(description)).hexdigest()
+
+def compile_key(model, pixels, loss=None, **hyperparams):
+    '''
+    Hash of everything a compiled function depends on. models.py and the Theano version,
+    device and floatX are part of the key so stale functions are never reused.
+    '''
+    models_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models.py')
+    fields = [('model', model), ('pixels', pixels), ('loss', loss),
+              ('models.py', file_hash(models_file)), ('theano', theano.__version__),
+              ('device', theano.config.device), ('floatX', theano.config.floatX)]
+    fields += sorted(hyperparams.items())
+    return hashlib.sha1(repr(fields)).hexdigest()
+
+def compiled_functions(output_layer, build_fn, model, pixels, loss=None, enabled=True, **hyperparams):
+    '''
+    Returns the dict build_fn() returns (Theano functions and shared variables for output_layer)
+    plus 'output_layer', from the cache if possible. Use the returned output_layer from then on.
+    model only names the cache file, the network is keyed by its structure.
+    '''
+    if not enabled:
+        functions = build_fn()
+        functions['output_layer'] = output_layer
+        return functions
+
+    # the network structure and the source of build_fn are part of the key, so editing the network
+    # or the functions a script compiles invalidates the cache
+    key = compile_key(model, pixels, loss, network=network_signature(output_layer),
+                      build=hashlib.md5(inspect.getsource(build_fn)).hexdigest(), **hyperparams)
+    filename = os.path.join(CACHE_DIR, '%s_%d_%s.pkl'%(model, pixels, key[:12]))
+    recursion_limit = sys.getrecursionlimit()
+    # deep networks nest deeper than the default recursion limit when pickled
+    sys.setrecursionlimit(max(recursion_limit, 50000))
+    start = time.time()
+    try:
+        if os.path.isfile(filename):
+            reoptimize = theano.config.reoptimize_unpickled_function
+            theano.config.reoptimize_unpickled_function = False
+            try:
+                with open(filename, 'rb') as f:
+                    cached = pickle.load(f)
+            finally:
+                theano.config.reoptimize_unpickled_function = reoptimize
+
+            functions = cached['functions']
+            helper.set_all_param_values(functions['output_layer'], helper.get_all_param_values(output_layer))
+            elapsed = time.time() - start
+            print('compile cache: loaded %s in %.1fs, building took %.1fs (saved %.1fs)'%(
+                  filename, elapsed, cached['build_time'], cached['build_time'] - elapsed))
+            return functions
+
+        functions = build_fn()
+        functions['output_layer'] = output_layer
+        build_time = time.time() - start
+
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        # write then rename so parallel folds never read a half written file
+        tmp_filename = '%s.%d.tmp'%(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump({'functions': functions, 'build_time': build_time}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+        print('compile cache: built in %.1fs, saved to %s'%(build_time, filename))
+        return functions
+    finally:
+        sys.setrecursionlimit(recursion_limit)
@@ -7,10 +7,7 @@ import argparse
 import gzip
 import cPickle as pickle
 
-from sklearn.cross_validation import KFold
-from skimage import transform
-from skimage.io import imshow, imsave, imread
-from sklearn.utils import shuffle
+from dataset import load_dataset
 
 '''
     Instead of using filenames, use indices
@@ -20,52 +17,48 @@ from sklearn.utils import shuffle
     filenames are stored just for sanity's sake
 '''
 
-import argparsing
-args, unknown_args = argparsing.parse_args()
-
-PIXELS = args.pixels
-
 IMG_FOLDER = os.path.join('data', 'imgs')
 RANDOM_STATE = 20
 
 
-def load_cv_fold(encoder, fold_idx=0):
-    global IMG_FOLDER
-    X_data_filename = 'data/cache/X_data_%d_f32.npy'%(PIXELS)
-    y_data_filename = 'data/cache/y_data_%d_f32.npy'%(PIXELS)
+def load_cv_fold(encoder, pixels, fold_idx=0, normalization=None, random_state=None):
+    '''
+    X_train and X_test are CachedImages views into one memory-mapped uint8 cache,
+    so the fold split and any number of loader workers share the data instead of copying it.
+    Float conversion and normalization happen per batch.
+    '''
+    from sklearn.utils import shuffle
 
-    X_data = np.load(X_data_filename)
-    y_data = np.load(y_data_filename)
+    X_data, y_data, _ = load_dataset('cv', pixels, normalization)
 
     with gzip.open(os.path.join('cv_folds.pklz')) as f:
         cv_folds = pickle.load(f)
 
-    X_train = X_data[..., cv_folds[fold_idx]['train']]
-    y_train = y_data[..., cv_folds[fold_idx]['train']]
+    train_index = np.array(cv_folds[fold_idx]['train'])
+    test_index = np.array(cv_folds[fold_idx]['test'])
 
-    X_test = X_data[..., cv_folds[fold_idx]['test']]
-    y_test = y_data[..., cv_folds[fold_idx]['test']]
+    y_train = y_data[train_index]
+    y_test = y_data[test_index]
 
     y_train = encoder.fit_transform(y_train).astype('int32')
     y_test = encoder.fit_transform(y_test).astype('int32')
 
-    X_train = X_train.transpose(3, 2, 0, 1) #/ 255.
-    X_test = X_test.transpose(3, 2, 0, 1) #/ 255.
-
-    # pixel mean should just be on the training set
-    # but to keep it simple across all folds, just do it on all of the data
-    if not os.path.isfile('data/pixel_mean_full_%d.npy'%PIXELS):
-        pixel_mean = np.mean(np.concatenate([X_train, X_test], axis=0), axis=0)
-        np.save('data/pixel_mean_full_%d.npy'%PIXELS, pixel_mean)
+    train_index, y_train = shuffle(train_index, y_train, random_state=random_state)
 
-    # subtract per-pixel mean
-    pixel_mean = np.load('data/pixel_mean_full_%d.npy'%PIXELS)
-    X_train -= pixel_mean
-    X_test -= pixel_mean
+    return X_data.subset(train_index), y_train, X_data.subset(test_index), y_test, encoder
 
-    X_train, y_train = shuffle(X_train, y_train)
+def cv_ids():
+    '''
+    'cN/name.jpg' id of every row of the cross validation cache, from the fold file names.
+    '''
+    with gzip.open(os.path.join('cv_folds.pklz')) as f:
+        cv_folds = pickle.load(f)
 
-    return X_train, y_train, X_test, y_test, encoder
+    ids = {}
+    for fold in cv_folds.values():
+        for index, fl in zip(fold['test'], fold['test_filenames']):
+            ids[index] = '/'.join(fl.split(os.sep)[-2:])
+    return np.array([ids[index] for index in range(len(ids))])
 
 def get_driver_data():
     dr = dict()
@@ -122,6 +115,8 @@ def get_driver_indices():
 
 # TODO: check to make sure there are no duplicates
 def create_cv_fold_yamls(nfolds=10):
+    from sklearn.cross_validation import KFold
+
     global RANDOM_STATE
     global IMG_FOLDER
 
@@ -152,47 +147,10 @@ def create_cv_fold_yamls(nfolds=10):
     with gzip.open(os.path.join('cv_folds.pklz'), 'w') as f:
         pickle.dump(cv_folds, f)
 
-def create_cv_cache(args):
-    global IMG_FOLDER
-    PIXELS = args.pixels
-    channels = 3
-
-    path = os.path.join(IMG_FOLDER, 'train', 'c*', '*.jpg')
-    total_files = len(glob.glob(path))
-
-    # preallocate to avoid double memory usage
-    X_data = np.empty((PIXELS, PIXELS, channels, total_files), dtype=np.float32)
-    y_data = np.empty(total_files, dtype=np.float32)
-
-    print('Read training images')
-
-    count = 0
-    for j in range(10):
-        print('Load folder c{}'.format(j))
-        path = os.path.join(IMG_FOLDER, 'train', 'c' + str(j), '*.jpg')
-        files = sorted(glob.glob(path))
-
-
-        for idx, fl in enumerate(files):
-            if idx%100 == 0:
-                print('%d of %d'%(idx, len(files)))
-
-            img = imread(fl)
-            X_data[..., count] = transform.resize(img, output_shape=(PIXELS, PIXELS, channels), preserve_range=True)
-            y_data[count] = j
-
-            count += 1
-
-
-    np.save('data/cache/X_data_%d_f32.npy'%(PIXELS), X_data)
-    np.save('data/cache/y_data_%d_f32.npy'%(PIXELS), y_data)
-
-    # pixel mean should just be on the training set
-    # but to keep it simple across all folds, just do it on all of the data
-    if not os.path.isfile('data/pixel_mean_full_%d.npy'%PIXELS):
-        pixel_mean = np.mean(X_data, axis=0)
-        np.save('data/pixel_mean_full_%d.npy'%PIXELS, pixel_mean)
-
+def create_cv_cache(pixels):
+    # same class then file name order as get_driver_indices, which the fold indices refer to
+    # the per-pixel mean is computed from the whole set the first time
+    load_dataset('cv', pixels, 'pixel_mean', cache=False)
 
 def get_label(fl):
     return int(fl.split(os.sep)[-2][1:])
@@ -215,6 +173,9 @@ def get_distribution():
 
 if __name__ == '__main__':
     #import ipdb; ipdb.set_trace()
+    import argparsing
+    args, unknown_args = argparsing.parse_args()
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--create_yamls', action='store_true', help='create cv yamls')
     parser.add_argument('--create_cache', action='store_true', help='create cv cache')
@@ -225,4 +186,4 @@ if __name__ == '__main__':
         create_cv_fold_yamls()
 
     if args_file.create_cache:
-        create_cv_cache(args)
+        create_cv_cache(args.pixels)
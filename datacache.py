@@ -0,0 +1,317 @@
+import os
+import glob
+import gzip
+import time
+import cPickle as pickle
+import multiprocessing
+import numpy as np
+from collections import deque
+
+'''
+On-disk image caches.
+
+Resized images are stored as uint8 in (N, C, H, W) order in a .npy file and opened
+with mmap_mode='r', so opening a cache is near-instant and only the rows a batch
+touches are ever read. Conversion to float32 and mean subtraction happen per batch
+in CachedImages.
+
+Each cache built from images has a manifest next to it recording the preprocessing
+params and the source path, size and mtime of every row, so rebuilding after a folder
+is cleaned or extended only decodes the new or changed files.
+'''
+
+def create_image_cache(filename, n_samples, channels, pixels):
+    '''
+    Preallocate a uint8 (N, C, H, W) cache on disk and return it as a writable memmap.
+    '''
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8,
+                                     shape=(n_samples, channels, pixels, pixels))
+
+def open_image_cache(filename):
+    return np.load(filename, mmap_mode='r')
+
+def to_uint8(img):
+    '''
+    Resized (H, W, C) or (H, W) float image in the 0-255 range to a uint8 (C, H, W) array.
+    '''
+    img = np.clip(np.round(img), 0, 255).astype(np.uint8)
+    if img.ndim == 2:
+        return img[None]
+    return img.transpose(2, 0, 1)
+
+def pixel_mean(X_cache, chunksize=1024):
+    '''
+    Per-pixel mean of a (N, C, H, W) cache, accumulated in chunks.
+    '''
+    n_samples = X_cache.shape[0]
+    pixel_sum = np.zeros(X_cache.shape[1:], dtype=np.float64)
+    for i in range(0, n_samples, chunksize):
+        pixel_sum += X_cache[i:i + chunksize].sum(axis=0, dtype=np.float64)
+    return (pixel_sum / n_samples).astype(np.float32)
+
+def convert_float_cache(src_filename, dst_filename, pixels, layout='flat', chunksize=1024, scale=1.):
+    '''
+    Convert an old float32 cache to the uint8 (N, C, H, W) format.
+    layout is 'flat' for (N, 1, C*H*W) / (N, C*H*W) caches from utils and 'hwcn' for
+    the (H, W, C, N) cross validation cache. Values are multiplied by scale first, 255 for
+    the old grayscale caches in the 0-1 range.
+    '''
+    X_float = np.load(src_filename, mmap_mode='r')
+    if layout == 'hwcn':
+        n_samples = X_float.shape[-1]
+        channels = X_float.shape[2]
+    else:
+        n_samples = X_float.shape[0]
+        channels = int(np.prod(X_float.shape[1:])) // (pixels * pixels)
+
+    X_cache = create_image_cache(dst_filename, n_samples, channels, pixels)
+    for i in range(0, n_samples, chunksize):
+        sl = slice(i, i + chunksize)
+        if layout == 'hwcn':
+            chunk = X_float[..., sl].transpose(3, 2, 0, 1)
+        else:
+            chunk = X_float[sl].reshape(-1, channels, pixels, pixels)
+        X_cache[sl] = np.clip(np.round(chunk * scale), 0, 255)
+    X_cache.flush()
+    del X_cache
+
+    return open_image_cache(dst_filename)
+
+def open_or_convert(filename, legacy_filename, pixels, layout='flat', scale=1.):
+    '''
+    Open a uint8 cache, converting it from the old float32 cache the first time.
+    '''
+    if not os.path.isfile(filename) and os.path.isfile(legacy_filename):
+        print('Converting %s to %s'%(legacy_filename, filename))
+        return convert_float_cache(legacy_filename, filename, pixels, layout, scale=scale)
+    return open_image_cache(filename)
+
+def normalize_batch(X, mean=None, scale=None, channel_order=None, out=None):
+    '''
+    Float32 (N, C, H, W) batch of X with channels reordered, mean subtracted and scaled,
+    written in one pass into out (allocated if None). A reversed channel order, RGB to
+    BGR, is read through a strided view, so apart from out no copy of the batch is made.
+    '''
+    if channel_order is not None:
+        if list(channel_order) == range(X.shape[1])[::-1]:
+            X = X[:, ::-1]
+        else:
+            X = X[:, channel_order]
+    if out is None:
+        out = np.empty(X.shape, dtype=np.float32)
+
+    if mean is None:
+        out[...] = X
+    else:
+        np.subtract(X, mean, out=out, dtype=np.float32)
+    if scale is not None:
+        out *= scale
+    return out
+
+class CachedImages(object):
+    '''
+    Float32 view of the rows of a uint8 (N, C, H, W) image cache, selected by index, without copying them.
+    Indexing with an int, slice or index array reads just those rows, reorders channels
+    if asked (e.g. RGB to BGR), subtracts mean and multiplies by scale.
+    Every loader worker and the trainer share the same memory-mapped pages.
+    '''
+    def __init__(self, base, index=None, mean=None, scale=None, channel_order=None):
+        self.base = base
+        self.index = np.arange(base.shape[0]) if index is None else np.asarray(index)
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32)
+        self.scale = scale
+        self.channel_order = channel_order
+        self.shape = (self.index.shape[0],) + base.shape[1:]
+        self.dtype = np.dtype(np.float32)
+        self.ndim = base.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def subset(self, index):
+        return CachedImages(self.base, self.index[index], self.mean, self.scale, self.channel_order)
+
+    def __getitem__(self, key):
+        if np.isscalar(key):
+            return self[key:key + 1][0]
+
+        return normalize_batch(self.base[self.index[key]], self.mean, self.scale, self.channel_order)
+
+    def __array__(self, dtype=None):
+        X = self[:]
+        return X if dtype is None else X.astype(dtype)
+
+def _decode_image(task):
+    '''
+    Decode and resize one image in a cache builder worker.
+    '''
+    from skimage.io import imread
+    from skimage import transform
+
+    filename, pixels, grayscale, order = task
+    img = imread(filename, as_grey=grayscale)
+    if grayscale:
+        # as_grey gives 0-1 floats
+        img = transform.resize(img, output_shape=(pixels, pixels), order=order, preserve_range=True) * 255.
+    else:
+        img = transform.resize(img, output_shape=(pixels, pixels, 3), order=order, preserve_range=True)
+    return to_uint8(img)
+
+def _decode_batch(task):
+    files, pixels, grayscale, order = task
+    return np.stack([_decode_image((fl, pixels, grayscale, order)) for fl in files])
+
+def stream_image_batches(files, pixels, batchsize, grayscale=False, workers=None, queue_size=8, start=0, order=1):
+    '''
+    Yield (offset, uint8 (N, C, H, W) batch) for files[start:] in order. Batches are decoded in a
+    process pool while the caller works on earlier ones, with at most queue_size batches in flight.
+    '''
+    workers = workers or multiprocessing.cpu_count()
+    tasks = ((offset, (files[offset:offset + batchsize], pixels, grayscale, order))
+             for offset in range(start, len(files), batchsize))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for offset, task in tasks:
+            pending.append((offset, pool.apply_async(_decode_batch, (task,))))
+            if len(pending) >= queue_size:
+                break
+        while pending:
+            offset, result = pending.popleft()
+            batch = result.get()
+            for next_offset, task in tasks:
+                pending.append((next_offset, pool.apply_async(_decode_batch, (task,))))
+                break
+            yield offset, batch
+    finally:
+        pool.terminate()
+        pool.join()
+
+def manifest_filename(filename):
+    return os.path.splitext(filename)[0] + '_manifest.pklz'
+
+def file_signature(filename):
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime)
+
+def load_manifest(filename):
+    '''
+    Manifest of the cache in filename: the preprocessing params and, per row, the
+    source path and its (size, mtime). None if there is no manifest or no cache, or if
+    the manifest does not describe the cache's rows.
+    '''
+    path = manifest_filename(filename)
+    if not os.path.isfile(path) or not os.path.isfile(filename):
+        return None
+    with gzip.open(path, 'rb') as f:
+        manifest = pickle.load(f)
+    n_rows = open_image_cache(filename).shape[0]
+    if len(manifest['files']) != n_rows:
+        print('Ignoring %s: %d files for the %d rows of %s'%(path, len(manifest['files']), n_rows, filename))
+        return None
+    return manifest
+
+def save_manifest(filename, manifest):
+    # write then rename so a reader never sees a half written manifest
+    path = manifest_filename(filename)
+    tmp_path = '%s.%d.tmp'%(path, os.getpid())
+    with gzip.open(tmp_path, 'wb') as f:
+        pickle.dump(manifest, f)
+    os.rename(tmp_path, path)
+
+def build_image_cache(files, filename, pixels, grayscale=False, workers=None, chunksize=16, order=1, incremental=True):
+    '''
+    Decode and resize files in a process pool, streaming the results in order into a
+    preallocated uint8 (N, C, H, W) cache on disk. Returns the cache opened read-only.
+
+    With incremental=True, rows whose source path, size and mtime match the existing cache's
+    manifest under the same pixels, grayscale and interpolation order are copied from it and
+    only new or changed files are decoded. Rows always follow the order of files.
+    '''
+    workers = workers or multiprocessing.cpu_count()
+    channels = 1 if grayscale else 3
+    n_files = len(files)
+    params = {'pixels': pixels, 'grayscale': grayscale, 'order': order}
+    signatures = [file_signature(fl) for fl in files]
+
+    old_rows = {}
+    manifest = load_manifest(filename) if incremental else None
+    if manifest is not None and manifest['params'] == params:
+        for row, (fl, signature) in enumerate(zip(manifest['files'], manifest['signatures'])):
+            old_rows[fl] = (row, signature)
+
+    reuse = []
+    decode = []
+    for row, (fl, signature) in enumerate(zip(files, signatures)):
+        if fl in old_rows and old_rows[fl][1] == signature:
+            reuse.append((row, old_rows[fl][0]))
+        else:
+            decode.append(row)
+
+    if manifest is not None and not decode and n_files == len(manifest['files']) and \
+            all(row == old_row for row, old_row in reuse):
+        print('%s is up to date'%filename)
+        return open_image_cache(filename)
+
+    # write next to the old cache so unchanged rows can be copied out of it
+    tmp_filename = os.path.splitext(filename)[0] + '_tmp.npy'
+    X_cache = create_image_cache(tmp_filename, n_files, channels, pixels)
+
+    if reuse:
+        X_old = open_image_cache(filename)
+        reuse = np.array(reuse)
+        for i in range(0, reuse.shape[0], 1024):
+            X_cache[reuse[i:i + 1024, 0]] = X_old[reuse[i:i + 1024, 1]]
+        del X_old
+        print('Reused %d of %d rows from %s'%(reuse.shape[0], n_files, filename))
+
+    n_decode = len(decode)
+    tasks = [(files[row], pixels, grayscale, order) for row in decode]
+
+    print('Building %s from %d images with %d workers'%(filename, n_decode, workers))
+    start = time.time()
+    pool = multiprocessing.Pool(workers)
+    try:
+        for count, img in enumerate(pool.imap(_decode_image, tasks, chunksize)):
+            X_cache[decode[count]] = img
+            if (count + 1)%1000 == 0:
+                print('%d of %d | %.1f img/s'%(count + 1, n_decode, (count + 1) / (time.time() - start)))
+    finally:
+        pool.terminate()
+        pool.join()
+    X_cache.flush()
+    del X_cache
+
+    elapsed = time.time() - start
+    print('Built %s: %d images in %.1fs (%.1f img/s)'%(filename, n_decode, elapsed, n_decode / max(elapsed, 1e-8)))
+
+    # drop the old manifest first, so a crash before the new one is saved leaves a cache without
+    # a manifest, rebuilt in full, instead of the new rows described by the old manifest
+    if os.path.isfile(manifest_filename(filename)):
+        os.remove(manifest_filename(filename))
+    os.rename(tmp_filename, filename)
+    save_manifest(filename, {'params': params, 'files': list(files), 'signatures': signatures})
+
+    return open_image_cache(filename)
+
+def list_images(folder):
+    '''
+    Sorted image files under folder. If folder has class subfolders (c0 ... c9), also returns
+    the labels and 'cN/name.jpg' ids, otherwise labels is None and ids are the file names.
+    '''
+    class_dirs = sorted(glob.glob(os.path.join(folder, 'c[0-9]*')))
+    if not class_dirs:
+        files = sorted(glob.glob(os.path.join(folder, '*.jpg')))
+        return files, None, [os.path.basename(fl) for fl in files]
+
+    files = []
+    labels = []
+    ids = []
+    for class_dir in sorted(class_dirs, key=lambda d: int(os.path.basename(d)[1:])):
+        label = int(os.path.basename(class_dir)[1:])
+        for fl in sorted(glob.glob(os.path.join(class_dir, '*.jpg'))):
+            files.append(fl)
+            labels.append(label)
+            ids.append(os.path.basename(class_dir) + '/' + os.path.basename(fl))
+    return files, np.array(labels), ids
@@ -0,0 +1,133 @@
+import os
+import argparse
+import numpy as np
+
+from datacache import CachedImages, build_image_cache, list_images, open_or_convert, pixel_mean
+
+'''
+One loader for every image set.
+
+Every dataset is a memory-mapped uint8 (N, C, H, W) cache built from an image folder
+and returned as CachedImages, which converts to float32 and normalizes whole batches
+as they are read. The normalization is a policy picked per model family:
+
+    pixel_mean  subtract the per-pixel mean of the set, for the networks trained from scratch
+    imagenet    swap RGB to BGR and subtract the ImageNet channel means, for the caffe GoogLeNet and ResNet
+    inception   subtract 128 and divide by 128, for Inception v3
+    unit        divide by 255, for the grayscale network used by relabel_training
+
+Build or refresh a cache with
+    python dataset.py --dataset train_cleaned -p 128
+'''
+
+IMG_FOLDER = os.path.join('data', 'imgs')
+
+# name: (image folder, cache prefix, cache suffix, layout of the old float32 cache)
+# the prefixes and suffixes keep the cache file names the old loaders used
+DATASETS = {
+    'train': ('train', 'train', '', 'flat'),
+    'train_cleaned': ('train_cleaned', 'train', '_clean', 'flat'),
+    'test': ('test', 'test', '', 'flat'),
+    'cv': ('train', 'data', '', 'hwcn'),
+}
+
+# the pixel mean is only ever computed from training images, never from the test set
+MEAN_DATASETS = ('train', 'train_cleaned', 'cv')
+
+NORMALIZATIONS = ('pixel_mean', 'imagenet', 'inception', 'unit')
+
+MODEL_NORMALIZATION = {
+    'resnet': 'pixel_mean',
+    'googlenet': 'imagenet',
+    'caffe_resnet': 'imagenet',
+    'inception_v3': 'inception',
+}
+
+# ImageNet BGR channel means for the pretrained caffe networks
+IMAGENET_MEAN = np.array([103.939, 116.779, 123.68], dtype=np.float32).reshape(3, 1, 1)
+
+def cache_filenames(name, pixels, grayscale=False):
+    '''
+    Image, label, id and old float32 cache file names of a dataset.
+    '''
+    folder, prefix, suffix, layout = DATASETS[name]
+    suffix += '_bw' if grayscale else ''
+    return ('data/cache/X_%s_%d_u8%s.npy'%(prefix, pixels, suffix),
+            'data/cache/y_%s_%d_f32%s.npy'%(prefix, pixels, suffix),
+            'data/cache/X_%s_id_%d_f32%s.npy'%(prefix, pixels, suffix),
+            'data/cache/X_%s_%d_f32%s.npy'%(prefix, pixels, suffix))
+
+def default_normalization(pixels):
+    # pixels of 224 are only used for finetuning the caffe networks and 299 for Inception v3
+    if pixels == 224:
+        return 'imagenet'
+    if pixels == 299:
+        return 'inception'
+    return 'pixel_mean'
+
+def normalize(X_cache, pixels, normalization=None, mean_file=None, compute_mean=False):
+    '''
+    Wrap a uint8 cache in CachedImages with a normalization policy or model family name.
+    pixel_mean reads mean_file, data/pixel_mean_full_<pixels>.npy by default. If it is
+    missing it is computed from X_cache with compute_mean, which only training caches
+    should set, and an IOError is raised otherwise.
+    '''
+    if normalization is None:
+        normalization = default_normalization(pixels)
+    normalization = MODEL_NORMALIZATION.get(normalization, normalization)
+
+    if normalization == 'pixel_mean':
+        mean_file = mean_file or 'data/pixel_mean_full_%d.npy'%pixels
+        if not os.path.isfile(mean_file):
+            if not compute_mean:
+                raise IOError('%s is missing, load a training set (train or cv) first to compute it'%mean_file)
+            # pixel mean should just be on the training set
+            # but to keep it simple across all folds, just do it on all of the data
+            np.save(mean_file, pixel_mean(X_cache))
+        return CachedImages(X_cache, mean=np.load(mean_file))
+    if normalization == 'imagenet':
+        return CachedImages(X_cache, mean=IMAGENET_MEAN, channel_order=[2,1,0])
+    if normalization == 'inception':
+        return CachedImages(X_cache, mean=128., scale=1/128.)
+    if normalization == 'unit':
+        return CachedImages(X_cache, scale=1/255.)
+    raise ValueError('normalization must be one of %s or a model family in %s, got %s'%(
+                     NORMALIZATIONS, sorted(MODEL_NORMALIZATION), normalization))
+
+def load_dataset(name, pixels, normalization=None, grayscale=False, cache=True, mean_file=None, workers=None, incremental=True):
+    '''
+    Returns the images of a dataset as normalized (N, C, H, W) CachedImages, the labels
+    (None for test) and the image ids. With cache=False the cache is (incrementally, see
+    datacache.build_image_cache) rebuilt from the image folder first.
+    '''
+    folder, prefix, suffix, layout = DATASETS[name]
+    X_filename, y_filename, id_filename, legacy_filename = cache_filenames(name, pixels, grayscale)
+
+    if cache:
+        # the old grayscale caches are as_grey images in the 0-1 range
+        X_cache = open_or_convert(X_filename, legacy_filename, pixels, layout, scale=255. if grayscale else 1.)
+        y = np.load(y_filename) if os.path.isfile(y_filename) else None
+        ids = np.load(id_filename) if os.path.isfile(id_filename) else None
+    else:
+        print('Read %s images'%name)
+        files, y, ids = list_images(os.path.join(IMG_FOLDER, folder))
+        X_cache = build_image_cache(files, X_filename, pixels, grayscale, workers, incremental=incremental)
+        ids = np.array(ids)
+        if y is not None:
+            np.save(y_filename, y)
+        np.save(id_filename, ids)
+
+    return normalize(X_cache, pixels, normalization, mean_file, compute_mean=name in MEAN_DATASETS), y, ids
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build or refresh the uint8 image cache of a dataset')
+    parser.add_argument('--dataset', type=str, default='train', choices=sorted(DATASETS), help='dataset')
+    parser.add_argument('-p', '--pixels', type=int, default=128, help='pixels')
+    parser.add_argument('--grayscale', action='store_true', help='single channel cache')
+    parser.add_argument('--workers', type=int, default=None, help='decode processes, defaults to the number of cores')
+    parser.add_argument('--full', action='store_true', help='decode every file instead of only new or changed ones')
+    args = parser.parse_args()
+
+    X, y, ids = load_dataset(args.dataset, args.pixels, 'unit', args.grayscale, cache=False,
+                             workers=args.workers, incremental=not args.full)
+    print('%s: %s'%(args.dataset, X.shape))
@@ -0,0 +1,151 @@
+import os
+import glob
+import gzip
+import time
+import argparse
+import cPickle as pickle
+import numpy as np
+
+from predstore import PRED_DIR, load_oof, prediction_filename
+
+'''
+Fit ensemble weights on out-of-fold predictions.
+
+Every fold of a model writes its predictions for the held out drivers of that fold into
+the model's shared data/preds/<model>_oof.npy (see predstore.save_oof), so after the ten
+folds of cv_folds.pklz it covers the whole training set once. Rows are stamped with the run
+that wrote them and a model whose folds come from different runs is rejected. collect_oof keeps only the
+probability of the true class, an (images, models) matrix Q, which is all the log loss
+of a weighted average needs: the blend's probability of the true class is Q.dot(w).
+
+fit_weights minimizes that log loss over the simplex (w = softmax(z)) with L-BFGS and the
+analytic gradient of all models at once, so hundreds of models fit in seconds. The
+weights are written as an average_preds manifest of the models' test predictions:
+
+    python ensemble_weights.py --kind tta_last --manifest ensemble.txt
+    python average_preds.py --manifest ensemble.txt --mean weighted --out subm/ensemble.csv
+'''
+
+# same clipping as the competition's log loss
+EPS = 1e-15
+
+def cv_targets(cv_file='cv_folds.pklz'):
+    '''
+    'cN/name.jpg' ids and labels of every image held out in some fold, in fold order,
+    and the fold of each.
+    '''
+    with gzip.open(cv_file) as f:
+        cv_folds = pickle.load(f)
+
+    ids = []
+    folds = []
+    for fold_idx in sorted(cv_folds):
+        for fl in cv_folds[fold_idx]['test_filenames']:
+            ids.append('/'.join(fl.split('/')[-2:]))
+            folds.append(fold_idx)
+    labels = np.array([int(img.split('/')[0][1:]) for img in ids])
+    return np.array(ids), labels, np.array(folds)
+
+def find_models(pred_dir=PRED_DIR):
+    '''
+    Model names with out-of-fold predictions, <model> in <model>_oof.npy.
+    '''
+    files = glob.glob(os.path.join(pred_dir, '*_oof.npy'))
+    return sorted(os.path.basename(fl)[:-len('_oof.npy')] for fl in files)
+
+def collect_oof(model, ids, labels, folds):
+    '''
+    Probability model gave the true class of every image in ids, from its shared out-of-fold
+    predictions. Raises ValueError naming the folds that have not written their rows yet, or the
+    folds per run if the rows come from more than one run of the experiment.
+    '''
+    oof, oof_ids, oof_runs = load_oof(model)
+    row_of = dict((img, row) for row, img in enumerate(oof_ids))
+    rows = np.array([row_of.get(img, -1) for img in ids], dtype=int)
+    if (rows < 0).any():
+        raise ValueError('%s has no rows for %d images, e.g. %s'%(model, (rows < 0).sum(), ids[rows < 0][0]))
+
+    true_probs = oof[rows, labels].astype(np.float64)
+    missing = np.isnan(true_probs)
+    if missing.any():
+        raise ValueError('%s has no out-of-fold predictions for folds %s'%(model, np.unique(folds[missing]).tolist()))
+
+    runs = oof_runs[rows]
+    if len(np.unique(runs)) > 1:
+        folds_of = ', '.join('run %s: folds %s'%(run, np.unique(folds[runs == run]).tolist()) for run in np.unique(runs))
+        raise ValueError('%s mixes predictions of several runs (%s), rerun the stale folds'%(model, folds_of))
+    return true_probs
+
+def log_loss(true_probs):
+    return -np.mean(np.log(np.clip(true_probs, EPS, 1.)))
+
+def fit_weights(Q, maxiter=500):
+    '''
+    Simplex weights w minimizing the log loss of Q.dot(w), Q the (images, models) true class
+    probabilities. Returns the weights and the out-of-fold log loss of the blend.
+    '''
+    from scipy.optimize import minimize
+
+    n_samples, n_models = Q.shape
+
+    def loss_grad(z):
+        w = np.exp(z - z.max())
+        w /= w.sum()
+        p = Q.dot(w)
+        clipped = np.clip(p, EPS, None)
+        loss = -np.mean(np.log(clipped))
+        # d loss / d w, zero where the clip is active, then through the softmax
+        grad_w = -Q.T.dot((p > EPS) / clipped) / n_samples
+        grad_z = w * (grad_w - w.dot(grad_w))
+        return loss, grad_z
+
+    result = minimize(loss_grad, np.zeros(n_models), jac=True, method='L-BFGS-B', options={'maxiter': maxiter})
+    w = np.exp(result.x - result.x.max())
+    w /= w.sum()
+    return w, log_loss(Q.dot(w))
+
+def write_manifest(filename, models, weights, kind, min_weight=1e-4):
+    '''
+    average_preds manifest of the test predictions data/preds/<model>_fold*_<kind>.npz,
+    each model's weight split evenly over its fold files. Models under min_weight are left out.
+    '''
+    with open(filename, 'w') as f:
+        for model, weight in sorted(zip(models, weights), key=lambda mw: -mw[1]):
+            if weight < min_weight:
+                continue
+            files = sorted(glob.glob(prediction_filename('%s_fold[0-9][0-9]'%model, kind)))
+            if not files:
+                raise ValueError('%s has no test predictions of kind %s'%(model, kind))
+            f.write('# %s %.6f\n'%(model, weight))
+            for fl in files:
+                f.write('%s %.8f\n'%(fl, weight / len(files)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fit ensemble weights on out-of-fold predictions')
+    parser.add_argument('models', type=str, nargs='*', help='models to blend, defaults to every model with out-of-fold predictions')
+    parser.add_argument('--kind', type=str, default='tta_last', help='kind of the test prediction stores to list in the manifest')
+    parser.add_argument('--manifest', type=str, default='ensemble.txt', help='average_preds manifest to write')
+    parser.add_argument('--maxiter', type=int, default=500)
+    args = parser.parse_args()
+
+    ids, labels, folds = cv_targets()
+    models = args.models or find_models()
+    if not models:
+        raise ValueError('no out-of-fold predictions in %s'%PRED_DIR)
+
+    start = time.time()
+    Q = np.empty((len(ids), len(models)), dtype=np.float64)
+    for m, model in enumerate(models):
+        Q[:, m] = collect_oof(model, ids, labels, folds)
+    print('Collected %d models x %d images in %.1fs'%(len(models), len(ids), time.time() - start))
+
+    start = time.time()
+    weights, loss = fit_weights(Q, args.maxiter)
+    print('Fit weights in %.2fs'%(time.time() - start))
+
+    for m in np.argsort(weights)[::-1]:
+        print('%8.4f  oof loss %.5f  %s'%(weights[m], log_loss(Q[:, m]), models[m]))
+    print('equal weights oof loss %.5f | fitted weights oof loss %.5f'%(log_loss(Q.mean(axis=1)), loss))
+
+    write_manifest(args.manifest, models, weights, args.kind)
+    print('Wrote %s'%args.manifest)
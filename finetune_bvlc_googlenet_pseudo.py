@@ -1,6 +1,5 @@
 import gzip
 import time
-import pickle
 import numpy as np
 
 import theano
@@ -8,14 +7,15 @@ from theano import tensor as T
 
 import lasagne
 from lasagne.updates import nesterov_momentum, adam
-from lasagne.layers import helper, DenseLayer
+from lasagne.layers import DenseLayer
 from lasagne.nonlinearities import softmax
 
 from sklearn.preprocessing import LabelEncoder
 
 from models import bvlc_googlenet
 from models import ST_ResNet_FullPre, ResNet_FullPre, ResNet_FullPre_Wide
-from utils import load_train_cv, batch_iterator_train, batch_iterator_valid, load_pseudo, batch_iterator_train_pseudo_lafriemont lookout
+from utils import load_train_cv, batch_iterator_train, batch_iterator_valid, load_pseudo, batch_iterator_train_pseudo_label
+from utils import PrefetchLoader, batch_iterator_train_prefetch
 
 
 from crossvalidation import load_cv_fold
@@ -24,6 +24,10 @@ from matplotlib import pyplot
 import warnings
 warnings.filterwarnings("ignore")
 
+from compilecache import compiled_functions
+from weightstore import save_params, load_params, pretrained_weights, weights_filename
+from shadowparams import ShadowParams, AverageParams, save_average
+
 import argparsing
 args, unknown_args = argparsing.parse_args()
 
@@ -63,43 +67,53 @@ def pseudo_log_loss(pred, y, eps=1e-15):
 
 # set up theano functions to generate output by feeding data through network, any test outputs should be deterministic
 net = bvlc_googlenet(X)
-# load network weights
-d = pickle.load(open('data/pre_trained_weights/blvc_googlenet.pkl'))
-helper.set_all_param_values(net['prob'], d['param values'])
 
 # stack our own softmax onto the final layer
 output_layer = DenseLayer(net['pool5/7x7_s1'], num_units=10, W=lasagne.init.HeNormal(), nonlinearity=softmax)
+# load the pretrained weights into every layer but our softmax, the file's classifier comes last and is left out
+load_params(output_layer, pretrained_weights('data/pre_trained_weights/blvc_googlenet.pkl'), skip_layers=[output_layer])
+
+def build_train_functions():
+    # standard output functions
+    output_train = lasagne.layers.get_output(output_layer)
+    output_test = lasagne.layers.get_output(output_layer, deterministic=True)
+
+    # set up the loss that we aim to minimize, when using cat cross entropy our Y should be ints not one-hot
+    loss = lasagne.objectives.categorical_crossentropy(output_train, Y)
+    loss = loss.mean()
 
-# standard output functions
-output_train = lasagne.layers.get_output(output_layer)
-output_test = lasagne.layers.get_output(output_layer, deterministic=True)
+    # L2 regularization
+    all_layers = lasagne.layers.get_all_layers(output_layer)
+    l2_penalty = lasagne.regularization.regularize_layer_params(all_layers, lasagne.regularization.l2) * 0.0001
+    loss = loss + l2_penalty
 
-# set up the loss that we aim to minimize, when using cat cross entropy our Y should be ints not one-hot
-loss = lasagne.objectives.categorical_crossentropy(output_train, Y)
-loss = loss.mean()
+    # set up loss functions for validation dataset
+    valid_loss = lasagne.objectives.categorical_crossentropy(output_test, Y)
+    valid_loss = valid_loss.mean()
 
-# L2 regularization
-all_layers = lasagne.layers.get_all_layers(output_layer)
-l2_penalty = lasagne.regularization.regularize_layer_params(all_layers, lasagne.regularization.l2) * 0.0001
-loss = loss + l2_penalty
+    valid_acc = T.mean(T.eq(T.argmax(output_test, axis=1), Y), dtype=theano.config.floatX)
 
-# set up loss functions for validation dataset
-valid_loss = lasagne.objectives.categorical_crossentropy(output_test, Y)
-valid_loss = valid_loss.mean()
+    # get parameters from network and set up sgd with nesterov momentum to update parameters
+    l_r = theano.shared(np.array(LR_SCHEDULE[0], dtype=theano.config.floatX))
+    params = lasagne.layers.get_all_params(output_layer, trainable=True)
+    updates = nesterov_momentum(loss, params, learning_rate=l_r)
 
-valid_acc = T.mean(T.eq(T.argmax(output_test, axis=1), Y), dtype=theano.config.floatX)
+    # set up training and prediction functions
+    train_fn = theano.function(inputs=[X,Y], outputs=loss, updates=updates)
+    valid_fn = theano.function(inputs=[X,Y], outputs=[valid_loss, valid_acc])
 
-# get parameters from network and set up sgd with nesterov momentum to update parameters
-l_r = theano.shared(np.array(LR_SCHEDULE[0], dtype=theano.config.floatX))
-params = lasagne.layers.get_all_params(output_layer, trainable=True)
-updates = nesterov_momentum(loss, params, learning_rate=l_r)
+    # set up prediction function
+    predict_proba = theano.function(inputs=[X], outputs=output_test)
 
-# set up training and prediction functions
-train_fn = theano.function(inputs=[X,Y], outputs=loss, updates=updates)
-valid_fn = theano.function(inputs=[X,Y], outputs=[valid_loss, valid_acc])
+    return {'train_fn': train_fn, 'valid_fn': valid_fn, 'predict_proba': predict_proba, 'l_r': l_r}
 
-# set up prediction function
-predict_proba = theano.function(inputs=[X], outputs=output_test)
+functions = compiled_functions(output_layer, build_train_functions, 'bvlc_googlenet', PIXELS, 'categorical_crossentropy+l2',
+                               enabled=not args.no_compile_cache, targets='soft', updates='nesterov_momentum')
+output_layer = functions['output_layer']
+train_fn = functions['train_fn']
+valid_fn = functions['valid_fn']
+predict_proba = functions['predict_proba']
+l_r = functions['l_r']
 
 '''
 load training data and start training
@@ -107,15 +121,18 @@ load training data and start training
 encoder = LabelEncoder()
 
 # load the training and validation data sets
-train_X, train_y, test_X, test_y, encoder = load_train_cv(encoder, cache=True)
+train_X, train_y, test_X, test_y, encoder = load_train_cv(encoder, PIXELS, cache=True, normalization='googlenet')
 train_y = train_y.astype('float32')
 test_y = test_y.astype('float32')
-pseudo_X, pseudo_labels = load_pseudo(cache=True)
+pseudo_X, pseudo_labels = load_pseudo(PIXELS, cache=True, normalization='googlenet', pseudo_file=args.pseudo)
 pseudo_labels = pseudo_labels.astype('float32')
 print 'Train shape:', train_X.shape, 'Test shape:', test_X.shape
 print 'Train y shape:', train_y.shape, 'Test y shape:', test_y.shape
 print 'Pseudo X shape:', pseudo_X.shape, 'pseudo y shape:', pseudo_labels.shape
-print np.amax(train_X), np.amin(train_X), np.mean(train_X)
+print np.amax(train_X[:BATCHSIZE]), np.amin(train_X[:BATCHSIZE]), np.mean(train_X[:BATCHSIZE])
+
+# augment mixed train/pseudo batches in background workers while the network trains
+loader = PrefetchLoader(train_X, train_y, BATCHSIZE, pseudo_X, pseudo_labels, workers=args.workers, seed=args.seed, aug_mode=args.aug_mode)
 
 
 # loop over training functions for however many iterations, print information while training
@@ -123,6 +140,10 @@ train_eval = []
 valid_eval = []
 valid_acc = []
 best_acc = 0.0
+# the best weights and the moving average stay on the device until they are saved
+best_weights = ShadowParams(output_layer)
+average_weights = AverageParams(output_layer, args.ema_decay) if args.ema_decay else None
+train_step = average_weights.wrap(train_fn) if average_weights is not None else train_fn
 try:
     for epoch in range(ITERS):
         # change learning rate according to schedules
@@ -131,7 +152,7 @@ try:
         # do the training
         start = time.time()
 
-        train_loss = batch_iterator_train_pseudo_label(train_X, train_y, pseudo_X, pseudo_labels, BATCHSIZE, train_fn)
+        train_loss = batch_iterator_train_prefetch(loader, epoch, train_step)
         train_eval.append(train_loss)
 
         valid_loss, acc_v = batch_iterator_valid(test_X, test_y, BATCHSIZE, valid_fn)
@@ -145,19 +166,18 @@ try:
 
         if acc_v > best_acc:
             best_acc = acc_v
-            best_params = helper.get_all_param_values(output_layer)
+            best_weights.copy()
 
 except KeyboardInterrupt:
     pass
 
+loader.close()
+
 print "Final Acc:", best_acc
 
 # save weights
-f = gzip.open('data/weights/%s_best.pklz'%experiment_label, 'wb')
-pickle.dump(best_params, f)
-f.close()
-
-last_params = helper.get_all_param_values(output_layer)
-f = gzip.open('data/weights/%s_last.pklz'%experiment_label, 'wb')
-pickle.dump(last_params, f)
-f.close()
+save_params(output_layer, weights_filename(experiment_label, 'best'), best_weights.values())
+save_params(output_layer, weights_filename(experiment_label, 'last'))
+# the average gets BatchNorm statistics of its own, this leaves the network averaged
+if average_weights is not None:
+    save_average(output_layer, average_weights, weights_filename(experiment_label, 'ema'), train_X, BATCHSIZE)
@@ -7,9 +7,14 @@ Need to download Caffe files form https://onedrive.live.com/?authkey=%21AAFW2-FV
 And place them in 'caffe_resnet' folder within script directory
 '''
 
+import time
 import caffe
 
+import theano
+from theano import tensor as T
+
 import lasagne
+from lasagne.updates import nesterov_momentum
 from lasagne.utils import floatX
 from lasagne.layers import InputLayer
 from lasagne.layers import Conv2DLayer as ConvLayer # can be replaced with dnn layers
@@ -29,6 +34,14 @@ import skimage.transform
 from IPython.display import Image
 import pickle
 
+from sklearn.preprocessing import LabelEncoder
+
+from utils import load_train_cv, batch_iterator_valid
+from utils import PrefetchLoader, batch_iterator_train_prefetch
+from compilecache import compiled_functions
+from weightstore import save_params, weights_filename
+from shadowparams import ShadowParams, AverageParams, save_average
+
 import argparsing
 args, unknown_args = argparsing.parse_args()
 
@@ -269,31 +282,42 @@ Y = T.ivector('y')
 # stack our own softmax onto the final layer
 output_layer = DenseLayer(net['pool5'], num_units=10, W=lasagne.init.HeNormal(), nonlinearity=softmax)
 
-# standard output functions
-output_train = lasagne.layers.get_output(output_layer)
-output_test = lasagne.layers.get_output(output_layer, deterministic=True)
+def build_train_functions():
+    # standard output functions
+    output_train = lasagne.layers.get_output(output_layer)
+    output_test = lasagne.layers.get_output(output_layer, deterministic=True)
+
+    # set up the loss that we aim to minimize, when using cat cross entropy our Y should be ints not one-hot
+    loss = lasagne.objectives.categorical_crossentropy(output_train, Y)
+    loss = loss.mean()
 
-# set up the loss that we aim to minimize, when using cat cross entropy our Y should be ints not one-hot
-loss = lasagne.objectives.categorical_crossentropy(output_train, Y)
-loss = loss.mean()
+    # set up loss functions for validation dataset
+    valid_loss = lasagne.objectives.categorical_crossentropy(output_test, Y)
+    valid_loss = valid_loss.mean()
 
-# set up loss functions for validation dataset
-valid_loss = lasagne.objectives.categorical_crossentropy(output_test, Y)
-valid_loss = valid_loss.mean()
+    valid_acc = T.mean(T.eq(T.argmax(output_test, axis=1), Y), dtype=theano.config.floatX)
 
-valid_acc = T.mean(T.eq(T.argmax(output_test, axis=1), Y), dtype=theano.config.floatX)
+    # get parameters from network and set up sgd with nesterov momentum to update parameters
+    l_r = theano.shared(np.array(LR_SCHEDULE[0], dtype=theano.config.floatX))
+    params = lasagne.layers.get_all_params(output_layer, trainable=True)
+    updates = nesterov_momentum(loss, params, learning_rate=l_r)
 
-# get parameters from network and set up sgd with nesterov momentum to update parameters
-l_r = theano.shared(np.array(LR_SCHEDULE[0], dtype=theano.config.floatX))
-params = lasagne.layers.get_all_params(output_layer, trainable=True)
-updates = nesterov_momentum(loss, params, learning_rate=l_r)
+    # set up training and prediction functions
+    train_fn = theano.function(inputs=[X,Y], outputs=loss, updates=updates)
+    valid_fn = theano.function(inputs=[X,Y], outputs=[valid_loss, valid_acc])
 
-# set up training and prediction functions
-train_fn = theano.function(inputs=[X,Y], outputs=loss, updates=updates)
-valid_fn = theano.function(inputs=[X,Y], outputs=[valid_loss, valid_acc])
+    # set up prediction function
+    predict_proba = theano.function(inputs=[X], outputs=output_test)
 
-# set up prediction function
-predict_proba = theano.function(inputs=[X], outputs=output_test)
+    return {'train_fn': train_fn, 'valid_fn': valid_fn, 'predict_proba': predict_proba, 'l_r': l_r}
+
+functions = compiled_functions(output_layer, build_train_functions, 'caffe_resnet', PIXELS, 'categorical_crossentropy',
+                               enabled=not args.no_compile_cache, targets='int', updates='nesterov_momentum')
+output_layer = functions['output_layer']
+train_fn = functions['train_fn']
+valid_fn = functions['valid_fn']
+predict_proba = functions['predict_proba']
+l_r = functions['l_r']
 
 
 '''
@@ -301,16 +325,23 @@ load training data and start training
 '''
 encoder = LabelEncoder()
 
-train_X, train_y, test_X, test_y, encoder = load_train_cv(encoder, cache=True, relabel=False)
+train_X, train_y, test_X, test_y, encoder = load_train_cv(encoder, PIXELS, cache=True, normalization='caffe_resnet')
 print 'Train shape:', train_X.shape, 'Test shape:', test_X.shape
 print 'Train y shape:', train_y.shape, 'Test y shape:', test_y.shape
-print np.amax(train_X), np.amin(train_X), np.mean(train_X)
+print np.amax(train_X[:BATCHSIZE]), np.amin(train_X[:BATCHSIZE]), np.mean(train_X[:BATCHSIZE])
+
+# augment batches in background workers while the network trains
+loader = PrefetchLoader(train_X, train_y, BATCHSIZE, workers=args.workers, seed=args.seed, aug_mode=args.aug_mode)
 
 # loop over training functions for however many iterations, print information while training
 train_eval = []
 valid_eval = []
 valid_acc = []
 best_acc = 0.0
+# the best weights and the moving average stay on the device until they are saved
+best_weights = ShadowParams(output_layer)
+average_weights = AverageParams(output_layer, args.ema_decay) if args.ema_decay else None
+train_step = average_weights.wrap(train_fn) if average_weights is not None else train_fn
 try:
     for epoch in range(ITERS):
         # change learning rate according to schedules
@@ -319,7 +350,7 @@ try:
         # do the training
         start = time.time()
 
-        train_loss = batch_iterator_train(train_X, train_y, BATCHSIZE, train_fn)
+        train_loss = batch_iterator_train_prefetch(loader, epoch, train_step)
         train_eval.append(train_loss)
 
         valid_loss, acc_v = batch_iterator_valid(test_X, test_y, BATCHSIZE, valid_fn)
@@ -333,19 +364,18 @@ try:
 
         if acc_v > best_acc:
             best_acc = acc_v
-            best_params = helper.get_all_param_values(output_layer)
+            best_weights.copy()
 
 except KeyboardInterrupt:
     pass
 
+loader.close()
+
 print "Final Acc:", best_acc
 
 # save weights
-f = gzip.open('data/weights/%s_best.pklz'%experiment_label, 'wb')
-pickle.dump(best_params, f)
-f.close()
-
-last_params = helper.get_all_param_values(output_layer)
-f = gzip.open('data/weights/%s_last.pklz'%experiment_label, 'wb')
-pickle.dump(last_params, f)
-f.close()
+save_params(output_layer, weights_filename(experiment_label, 'best'), best_weights.values())
+save_params(output_layer, weights_filename(experiment_label, 'last'))
+# the average gets BatchNorm statistics of its own, this leaves the network averaged
+if average_weights is not None:
+    save_average(output_layer, average_weights, weights_filename(experiment_label, 'ema'), train_X, BATCHSIZE)
@@ -1,6 +1,4 @@
 #!/bin/bash
 
-for i in {0..9}
-do
-    python finetune_bvlc_googlenet.py --label GoogLeNet --pixels 224 --fold $i --batchsize 32
-done
+python run_folds.py --slots ${SLOTS:-1} --folds 0-9 \
+    --step "finetune_bvlc_googlenet.py --label GoogLeNet --pixels 224 --batchsize 32"
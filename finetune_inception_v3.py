@@ -1,6 +1,5 @@
 import gzip
 import time
-import pickle
 import numpy as np
 
 import theano
@@ -8,7 +7,7 @@ from theano import tensor as T
 
 import lasagne
 from lasagne.updates import nesterov_momentum, adam
-from lasagne.layers import helper, DenseLayer
+from lasagne.layers import DenseLayer
 from lasagne.nonlinearities import softmax
 
 from sklearn.preprocessing import LabelEncoder
@@ -18,7 +17,12 @@ from sklearn.utils import shuffle
 from models import inception_v3
 from models import ST_ResNet_FullPre, ResNet_FullPre, ResNet_FullPre_Wide
 from utils import load_train_cv, batch_iterator_train, batch_iterator_valid, load_pseudo
+from utils import PrefetchLoader, batch_iterator_train_prefetch
 from crossvalidation import load_cv_fold
+from dataset import load_dataset
+from compilecache import compiled_functions
+from weightstore import save_params, load_params, pretrained_weights, weights_filename
+from shadowparams import ShadowParams, AverageParams, save_average
 
 from matplotlib import pyplot
 import warnings
@@ -49,66 +53,80 @@ Y = T.ivector('y')
 
 # set up theano functions to generate output by feeding data through network, any test outputs should be deterministic
 net = inception_v3(X)
-# load network weights
-d = pickle.load(open('data/pre_trained_weights/inception_v3.pkl'))
-helper.set_all_param_values(net['softmax'], d['param values'])
 
 # stack our own softmax onto the final layer
 output_layer = DenseLayer(net['pool3'], num_units=10, W=lasagne.init.HeNormal(), nonlinearity=softmax)
+# load the pretrained weights into every layer but our softmax, the file's classifier comes last and is left out
+load_params(output_layer, pretrained_weights('data/pre_trained_weights/inception_v3.pkl'), skip_layers=[output_layer])
 
-# standard output functions
-output_train = lasagne.layers.get_output(output_layer)
-output_test = lasagne.layers.get_output(output_layer, deterministic=True)
+def build_train_functions():
+    # standard output functions
+    output_train = lasagne.layers.get_output(output_layer)
+    output_test = lasagne.layers.get_output(output_layer, deterministic=True)
 
-# set up the loss that we aim to minimize, when using cat cross entropy our Y should be ints not one-hot
-loss = lasagne.objectives.categorical_crossentropy(output_train, Y)
-loss = loss.mean()
+    # set up the loss that we aim to minimize, when using cat cross entropy our Y should be ints not one-hot
+    loss = lasagne.objectives.categorical_crossentropy(output_train, Y)
+    loss = loss.mean()
 
-# set up loss functions for validation dataset
-valid_loss = lasagne.objectives.categorical_crossentropy(output_test, Y)
-valid_loss = valid_loss.mean()
+    # set up loss functions for validation dataset
+    valid_loss = lasagne.objectives.categorical_crossentropy(output_test, Y)
+    valid_loss = valid_loss.mean()
 
-valid_acc = T.mean(T.eq(T.argmax(output_test, axis=1), Y), dtype=theano.config.floatX)
+    valid_acc = T.mean(T.eq(T.argmax(output_test, axis=1), Y), dtype=theano.config.floatX)
 
-# get parameters from network and set up sgd with nesterov momentum to update parameters
-l_r = theano.shared(np.array(LR_SCHEDULE[0], dtype=theano.config.floatX))
-params = lasagne.layers.get_all_params(output_layer, trainable=True)
-updates = nesterov_momentum(loss, params, learning_rate=l_r)
+    # get parameters from network and set up sgd with nesterov momentum to update parameters
+    l_r = theano.shared(np.array(LR_SCHEDULE[0], dtype=theano.config.floatX))
+    params = lasagne.layers.get_all_params(output_layer, trainable=True)
+    updates = nesterov_momentum(loss, params, learning_rate=l_r)
 
-# set up training and prediction functions
-train_fn = theano.function(inputs=[X,Y], outputs=loss, updates=updates)
-valid_fn = theano.function(inputs=[X,Y], outputs=[valid_loss, valid_acc])
+    # set up training and prediction functions
+    train_fn = theano.function(inputs=[X,Y], outputs=loss, updates=updates)
+    valid_fn = theano.function(inputs=[X,Y], outputs=[valid_loss, valid_acc])
 
-# set up prediction function
-predict_proba = theano.function(inputs=[X], outputs=output_test)
+    # set up prediction function
+    predict_proba = theano.function(inputs=[X], outputs=output_test)
+
+    return {'train_fn': train_fn, 'valid_fn': valid_fn, 'predict_proba': predict_proba, 'l_r': l_r}
+
+functions = compiled_functions(output_layer, build_train_functions, 'inception_v3', PIXELS, 'categorical_crossentropy',
+                               enabled=not args.no_compile_cache, targets='int', updates='nesterov_momentum')
+output_layer = functions['output_layer']
+train_fn = functions['train_fn']
+valid_fn = functions['valid_fn']
+predict_proba = functions['predict_proba']
+l_r = functions['l_r']
 
 '''
 load training data and start training
 '''
 encoder = LabelEncoder()
 
-# load data
-X_train = np.load('data/cache/X_train_%d_f32_clean.npy'%PIXELS)
-y_train = np.load('data/cache/y_train_%d_f32_clean.npy'%PIXELS)
-
-# scale data
-X_train -= 128
-X_train /= 128
+# load data, memory-mapped uint8 so the 299 px set does not have to fit in memory as float32
+X_data, y_train, _ = load_dataset('train_cleaned', PIXELS, 'inception_v3')
 
 # split data into train and validation
 y_train = encoder.fit_transform(y_train).astype('int32')
-X_train, y_train = shuffle(X_train, y_train)
-X_train, X_test, y_train, y_test = train_test_split(X_train, y_train, test_size=0.15)
+train_index, y_train = shuffle(np.arange(X_data.shape[0]), y_train)
+train_index, test_index, y_train, y_test = train_test_split(train_index, y_train, test_size=0.15)
+X_train = X_data.subset(train_index)
+X_test = X_data.subset(test_index)
 
 print 'Train shape:', X_train.shape, 'Test shape:', X_test.shape
 print 'Train y shape:', y_train.shape, 'Test y shape:', y_test.shape
-print np.amax(X_train), np.amin(X_train), np.mean(X_train)
+print np.amax(X_train[:BATCHSIZE]), np.amin(X_train[:BATCHSIZE]), np.mean(X_train[:BATCHSIZE])
+
+# augment batches in background workers while the network trains
+loader = PrefetchLoader(X_train, y_train, BATCHSIZE, workers=args.workers, seed=args.seed, aug_mode=args.aug_mode)
 
 # loop over training functions for however many iterations, print information while training
 train_eval = []
 valid_eval = []
 valid_acc = []
 best_acc = 0.0
+# the best weights and the moving average stay on the device until they are saved
+best_weights = ShadowParams(output_layer)
+average_weights = AverageParams(output_layer, args.ema_decay) if args.ema_decay else None
+train_step = average_weights.wrap(train_fn) if average_weights is not None else train_fn
 try:
     for epoch in range(ITERS):
         # change learning rate according to schedules
@@ -117,7 +135,7 @@ try:
         # do the training
         start = time.time()
 
-        train_loss = batch_iterator_train(X_train, y_train, BATCHSIZE, train_fn)
+        train_loss = batch_iterator_train_prefetch(loader, epoch, train_step)
         train_eval.append(train_loss)
 
         valid_loss, acc_v = batch_iterator_valid(X_test, y_test, BATCHSIZE, valid_fn)
@@ -131,19 +149,18 @@ try:
 
         if acc_v > best_acc:
             best_acc = acc_v
-            best_params = helper.get_all_param_values(output_layer)
+            best_weights.copy()
 
 except KeyboardInterrupt:
     pass
 
+loader.close()
+
 print "Final Acc:", best_acc
 
 # save weights
-f = gzip.open('data/weights/%s_best.pklz'%experiment_label, 'wb')
-pickle.dump(best_params, f)
-f.close()
-
-last_params = helper.get_all_param_values(output_layer)
-f = gzip.open('data/weights/%s_last.pklz'%experiment_label, 'wb')
-pickle.dump(last_params, f)
-f.close()
+save_params(output_layer, weights_filename(experiment_label, 'best'), best_weights.values())
+save_params(output_layer, weights_filename(experiment_label, 'last'))
+# the average gets BatchNorm statistics of its own, this leaves the network averaged
+if average_weights is not None:
+    save_average(output_layer, average_weights, weights_filename(experiment_label, 'ema'), X_train, BATCHSIZE)
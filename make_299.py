@@ -17,6 +17,8 @@ from skimage import transform, filters, exposure, img_as_ubyte
 import theano
 from theano import tensor as T
 
+from dataset import load_dataset
+
 import argparsing
 args, unknown_args = argparsing.parse_args()
 
@@ -25,32 +27,6 @@ imageSize = PIXELS * PIXELS
 num_features = imageSize * 3
 
 def load_train_cv():
-    X_train = np.empty(shape=(21794, 3, 299, 299), dtype='float32')
-    X_train_id = []
-    y_train = np.empty(shape=(21794,1), dtype='int')
-    print('Read train images')
-    file_count = 0
-    for j in range(10):
-        print('Load folder c{}'.format(j))
-        path = os.path.join('data', 'imgs', 'train_cleaned', 'c' + str(j), '*.jpg')
-        files = glob.glob(path)
-        for fl in files:
-            print fl
-            flbase = os.path.basename(fl)
-            img = imread(fl)
-            img = transform.resize(img, output_shape=(PIXELS, PIXELS, 3), preserve_range=True)
-            img = img.transpose(2, 0, 1).astype('float32')
-            #img = np.reshape(img, (1, num_features)).astype('float32')
-            X_train[file_count] = img
-            y_train[file_count] = j
-            file_count += 1
-            X_train_id.append('c' + str(j) + '/' + str(flbase))
-
-    X_train_id = np.array(X_train_id)
-    y_train = np.array(y_train)
-
-    np.save('data/cache/X_train_%d_f32_clean.npy'%PIXELS, X_train)
-    np.save('data/cache/y_train_%d_f32_clean.npy'%PIXELS, y_train)
-    np.save('data/cache/X_train_id_%d_f32_clean.npy'%PIXELS, X_train_id)
+    load_dataset('train_cleaned', PIXELS, 'inception_v3', cache=False)
 
 load_train_cv()
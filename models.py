@@ -15,20 +15,12 @@ from lasagne.init import Orthogonal, HeNormal, GlorotNormal, HeUniform
 from lasagne.layers.dnn import MaxPool2DDNNLayer as PoolLayerDNN
 from lasagne.layers import LocalResponseNormalization2DLayer as LRNLayer
 
-import argparsing
-args, unknown_args = argparsing.parse_args()
-
-PIXELS = args.pixels
-
-imageSize = PIXELS * PIXELS
-num_features = imageSize * 3
-
 ortho = Orthogonal(gain='relu')
 he_norm = HeNormal(gain='relu')
 xavier_norm = GlorotNormal(gain=1.0)
 
-def vgg16_old(input_var=None):
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+def vgg16_old(input_var=None, pixels=128):
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     l_conv1a = batch_norm(Conv2DLayer(l_in, num_filters=64, filter_size=3, pad=1, W=he_norm, nonlinearity=rectify))
     l_conv1b = batch_norm(Conv2DLayer(l_conv1a, num_filters=64, filter_size=3, pad=1, W=he_norm, nonlinearity=rectify))
@@ -66,8 +58,8 @@ def vgg16_old(input_var=None):
 
 # ========================================================================================================================
 
-def vgg16(input_var=None):
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+def vgg16(input_var=None, pixels=128):
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     l_conv1a = batch_norm(Conv2DLayer(l_in, num_filters=32, filter_size=3, pad=1, W=he_norm, nonlinearity=very_leaky_rectify))
     l_conv1b = batch_norm(Conv2DLayer(l_conv1a, num_filters=32, filter_size=3, pad=1, W=he_norm, nonlinearity=very_leaky_rectify))
@@ -99,8 +91,8 @@ def vgg16(input_var=None):
 
 # ========================================================================================================================
 
-def vgg16_fc7(input_var=None):
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+def vgg16_fc7(input_var=None, pixels=128):
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     l_conv1a = batch_norm(Conv2DLayer(l_in, num_filters=64, filter_size=3, pad=1, W=ortho, nonlinearity=rectify))
     l_conv1b = batch_norm(Conv2DLayer(l_conv1a, num_filters=64, filter_size=3, pad=1, W=ortho, nonlinearity=rectify))
@@ -142,7 +134,7 @@ def vgg16_fc7(input_var=None):
 
 # ========================================================================================================================
 
-def ResNet_Orig(input_var=None, n=9):
+def ResNet_Orig(input_var=None, n=9, pixels=128):
     '''
     Stolen from from https://github.com/Lasagne/Recipes/tree/master/papers/deep_residual_learning ;-)
     '''
@@ -177,7 +169,7 @@ def ResNet_Orig(input_var=None, n=9):
         return block
 
     # Building the network
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     # first layer, output is 64 x 32 x 32
     l = batch_norm(Conv2DDNNLayer(l_in, num_filters=16, filter_size=(3,3), stride=(1,1), nonlinearity=rectify, pad='same', W=lasagne.init.HeNormal(gain='relu')))
@@ -209,7 +201,7 @@ def ResNet_Orig(input_var=None, n=9):
 
 # ========================================================================================================================
 
-def ResNet_Orig_ELU(input_var=None, n=5):
+def ResNet_Orig_ELU(input_var=None, n=5, pixels=128):
     '''
     Stolen from from https://github.com/Lasagne/Recipes/tree/master/papers/deep_residual_learning ;-)
     '''
@@ -238,7 +230,7 @@ def ResNet_Orig_ELU(input_var=None, n=5):
         return block
 
     # Building the network
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     # first layer, output is 64 x 32 x 32
     l = ConvLayer(l_in, num_filters=16, filter_size=(3,3), stride=(1,1), nonlinearity=elu, pad='same', W=lasagne.init.HeNormal(gain='relu'))
@@ -271,7 +263,7 @@ def ResNet_Orig_ELU(input_var=None, n=5):
 
 # ========================================================================================================================
 
-def ResNet_FullPre(input_var=None, n=5):
+def ResNet_FullPre(input_var=None, n=5, pixels=128):
     '''
     Adapted from https://github.com/Lasagne/Recipes/tree/master/papers/deep_residual_learning.
     Tweaked to be consistent with 'Identity Mappings in Deep Residual Networks', Kaiming He et al. 2016 (https://arxiv.org/abs/1603.05027)
@@ -317,7 +309,7 @@ def ResNet_FullPre(input_var=None, n=5):
         return block
 
     # Building the network
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     # first layer, output is 16 x 64 x 64
     l = batch_norm(ConvLayer(l_in, num_filters=16, filter_size=(5,5), stride=(1,1), nonlinearity=rectify, pad='same', W=he_norm))
@@ -363,7 +355,7 @@ def ResNet_FullPre(input_var=None, n=5):
 
 # ========================================================================================================================
 
-def ResNet_FullPre_Wide(input_var=None, n=5, k=2):
+def ResNet_FullPre_Wide(input_var=None, n=5, k=2, pixels=128):
     '''
     Adapted from https://github.com/Lasagne/Recipes/tree/master/papers/deep_residual_learning.
     Tweaked to be consistent with 'Identity Mappings in Deep Residual Networks', Kaiming He et al. 2016 (https://arxiv.org/abs/1603.05027)
@@ -413,7 +405,7 @@ def ResNet_FullPre_Wide(input_var=None, n=5, k=2):
         return block
 
     # Building the network
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     # first layer, output is 16 x 64 x 64
     l = batch_norm(ConvLayer(l_in, num_filters=n_filters[0], filter_size=(7,7), stride=(2,2), nonlinearity=rectify, pad='same', W=he_norm))
@@ -455,7 +447,7 @@ def ResNet_FullPre_Wide(input_var=None, n=5, k=2):
 
 # ========================================================================================================================
 
-def ST_ResNet_FullPre(input_var=None, n=5, k=2):
+def ST_ResNet_FullPre(input_var=None, n=5, k=2, pixels=128):
     '''
     Spatial Transformer ResNet
     'Spatial Transformer Networks', Max Jaderberg, Karen Simonyan, Andrew Zisserman, Koray Kavukcuoglu (https://arxiv.org/pdf/1506.02025v3.pdf)
@@ -510,7 +502,7 @@ def ST_ResNet_FullPre(input_var=None, n=5, k=2):
         return block
 
     # Building the network
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     # Localization network
     # same architecture as svhn localization network from paper
@@ -587,7 +579,7 @@ def ST_ResNet_FullPre(input_var=None, n=5, k=2):
 
 # ========================================================================================================================
 
-def ResNet_FullPre_ELU(input_var=None, n=5):
+def ResNet_FullPre_ELU(input_var=None, n=5, pixels=128):
     '''
     Adapted from https://github.com/Lasagne/Recipes/tree/master/papers/deep_residual_learning.
     Tweaked to be consistent with 'Identity Mappings in Deep Residual Networks', Kaiming He et al. 2016 (https://arxiv.org/abs/1603.05027)
@@ -628,7 +620,7 @@ def ResNet_FullPre_ELU(input_var=None, n=5):
         return block
 
     # Building the network
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     # first layer, output is 16 x 128 x 128
     l = ConvLayer(l_in, num_filters=16, filter_size=(3,3), stride=(1,1), nonlinearity=elu, pad='same', W=ortho)
@@ -667,7 +659,7 @@ def ResNet_FullPre_ELU(input_var=None, n=5):
 
 # ========================================================================================================================
 
-def ResNet_BttlNck_FullPre(input_var=None, n=18):
+def ResNet_BttlNck_FullPre(input_var=None, n=18, pixels=128):
     '''
     Adapted from https://github.com/Lasagne/Recipes/tree/master/papers/deep_residual_learning.
     Tweaked to be consistent with 'Identity Mappings in Deep Residual Networks', Kaiming He et al. 2016 (https://arxiv.org/abs/1603.05027)
@@ -712,7 +704,7 @@ def ResNet_BttlNck_FullPre(input_var=None, n=18):
         return block
 
     # Building the network
-    l_in = InputLayer(shape=(None, 3, PIXELS, PIXELS), input_var=input_var)
+    l_in = InputLayer(shape=(None, 3, pixels, pixels), input_var=input_var)
 
     # first layer, output is 64 x 32 x 32
     l = batch_norm(ConvLayer(l_in, num_filters=64, filter_size=(3,3), stride=(1,1), nonlinearity=rectify, pad=1, W=he_norm))
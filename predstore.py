@@ -0,0 +1,133 @@
+import os
+import numpy as np
+
+'''
+Binary prediction store.
+
+Intermediate predictions (per fold, per TTA run, per model) are saved as an uncompressed
+.npz holding the (images, classes) predictions, float16 by default, the img ids the rows
+belong to and the class column names. Ensembling and pseudo labeling read these instead
+of parsing csv, and rows are always matched by id, never by position. Only the final
+submission is written as csv, with write_submission.
+'''
+
+PRED_DIR = os.path.join('data', 'preds')
+CLASSES = ['c0', 'c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7', 'c8', 'c9']
+
+def prediction_filename(label, kind):
+    '''
+    data/preds/<label>_<kind>.npz, e.g. kind tta_last or finetune.
+    '''
+    return os.path.join(PRED_DIR, '%s_%s.npz'%(label, kind))
+
+def save_predictions(filename, predictions, ids, columns=CLASSES, dtype=np.float16):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # write then rename so a reader never sees a half written store
+    tmp_filename = filename + '.tmp.npz'
+    np.savez(tmp_filename, predictions=np.asarray(predictions, dtype=dtype),
+             ids=np.asarray(ids, dtype=str), columns=np.asarray(columns, dtype=str))
+    os.rename(tmp_filename, filename)
+
+def load_predictions(filename):
+    '''
+    Returns the float32 predictions, ids and class columns of a store.
+    '''
+    d = np.load(filename)
+    return d['predictions'].astype(np.float32), d['ids'], list(d['columns'])
+
+def align_rows(predictions, prediction_ids, ids, filename):
+    '''
+    Rows of predictions, which are in the order of prediction_ids, reordered to ids.
+    '''
+    row_of = dict((img, row) for row, img in enumerate(prediction_ids))
+    rows = np.array([row_of.get(img, -1) for img in ids], dtype=int)
+    if (rows < 0).any():
+        raise ValueError('%s has no predictions for %d of the ids, e.g. %s'%(filename, (rows < 0).sum(), np.asarray(ids)[rows < 0][0]))
+    return predictions[rows]
+
+def aligned_predictions(filename, ids, columns=CLASSES):
+    '''
+    Predictions of a store reordered to the given ids and class columns.
+    '''
+    predictions, store_ids, store_columns = load_predictions(filename)
+    return align_rows(predictions, store_ids, ids, filename)[:, [store_columns.index(c) for c in columns]]
+
+def oof_filename(experiment):
+    '''
+    data/preds/<experiment>_oof.npy, the out-of-fold predictions of every fold of an experiment.
+    '''
+    return os.path.join(PRED_DIR, '%s_oof.npy'%experiment)
+
+# run ids are stored per row as fixed width strings
+RUN_ID_DTYPE = 'S40'
+
+def _create_once(filename, dtype, shape, fill):
+    '''
+    Create a .npy filled with fill unless it exists. Never overwrites a file another fold created first.
+    '''
+    if os.path.isfile(filename):
+        return
+    tmp_filename = '%s.%d.tmp.npy'%(filename, os.getpid())
+    array = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=dtype, shape=shape)
+    array[:] = fill
+    del array
+    try:
+        # link fails if another fold created the file first, so its rows are never lost
+        os.link(tmp_filename, filename)
+    except OSError:
+        pass
+    os.remove(tmp_filename)
+
+def save_oof(experiment, index, predictions, ids, run_id):
+    '''
+    Write one fold's out-of-fold predictions into rows index of the experiment's shared float32
+    (len(ids), classes) array, indexed like the cross validation cache. Rows no fold has written
+    yet are NaN. Folds running in parallel write their own rows of the same memory-mapped file.
+    Every row also records the run_id of the run that wrote it, so rows left over from an earlier
+    run of the same experiment are told apart from the current run's (see load_oof).
+    '''
+    filename = oof_filename(experiment)
+    if not os.path.isdir(PRED_DIR):
+        os.makedirs(PRED_DIR)
+    # the run file is created before the predictions, so whoever sees the predictions sees it too
+    _create_once(filename.replace('.npy', '_runs.npy'), RUN_ID_DTYPE, (len(ids),), '')
+    _create_once(filename, np.float32, (len(ids), predictions.shape[1]), np.nan)
+    if not os.path.isfile(filename.replace('.npy', '_ids.npy')):
+        np.save(filename.replace('.npy', '_ids.npy'), np.asarray(ids, dtype=str))
+
+    oof = np.load(filename, mmap_mode='r+')
+    runs = np.load(filename.replace('.npy', '_runs.npy'), mmap_mode='r+')
+    if oof.shape[0] != len(ids):
+        raise ValueError('%s has %d rows, expected %d'%(filename, oof.shape[0], len(ids)))
+    oof[index] = predictions
+    oof.flush()
+    runs[index] = run_id
+    runs.flush()
+    del oof, runs
+
+def load_oof(experiment):
+    '''
+    Returns the shared out-of-fold predictions of an experiment, NaN where missing, their ids and
+    the run id of every row, '' where missing.
+    '''
+    filename = oof_filename(experiment)
+    runs_filename = filename.replace('.npy', '_runs.npy')
+    oof = np.load(filename)
+    # arrays from before run ids count as one unnamed run
+    runs = np.load(runs_filename) if os.path.isfile(runs_filename) else np.array(['unknown'] * len(oof), dtype=RUN_ID_DTYPE)
+    return oof, np.load(filename.replace('.npy', '_ids.npy')), runs
+
+def write_submission(filename, predictions, ids, columns=CLASSES):
+    '''
+    Final submission csv: img followed by one column per class.
+    '''
+    import pandas as pd
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    result = pd.DataFrame(predictions, columns=columns)
+    result.insert(0, 'img', ids)
+    result.to_csv(filename, index=False)
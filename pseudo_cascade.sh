@@ -1,7 +1,5 @@
 #!/bin/bash
 
-for i in {0..9}
-do
-    python train_nn_pseudo.py --label wide_resnet_n5_k4_7x7_pseudo --pixels 128 --fold $i --batchsize 32 --epochs 200
-    python gen_pseudo_cascade.py --label wide_resnet_n5_k4_7x7_pseudo --pixels 128 --fold $i
-done
+python run_folds.py --slots ${SLOTS:-1} --folds 0-9 \
+    --step "train_nn_pseudo.py --label wide_resnet_n5_k4_7x7_pseudo --pixels 128 --batchsize 32 --epochs 200" \
+    --step "gen_pseudo_cascade.py --label wide_resnet_n5_k4_7x7_pseudo --pixels 128"
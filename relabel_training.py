@@ -23,6 +23,8 @@ from skimage import transform, filters, exposure
 
 from models import ResNet_FullPre
 from utils import load_test, batch_iterator_train, batch_iterator_valid
+from dataset import load_dataset
+from weightstore import load_params, weights_filename
 
 from matplotlib import pyplot
 
@@ -43,7 +45,7 @@ X = T.tensor4('X')
 Y = T.ivector('y')
 
 # set up theano functions to generate output by feeding data through network, any test outputs should be deterministic
-output_layer = ResNet_FullPre(X, n=5)
+output_layer = ResNet_FullPre(X, n=5, pixels=PIXELS)
 output_test = lasagne.layers.get_output(output_layer, deterministic=True)
 
 output_class = T.argmax(output_test, axis=1)
@@ -56,15 +58,11 @@ predict_class = theano.function(inputs=[X], outputs=output_class)
 Load data and make predictions
 '''
 # load data
-X_train = np.load('data/cache/X_train_128_f32_bw.npy')
-X_train = np.array(X_train)
-X_train = X_train.reshape(X_train.shape[0], 1, PIXELS, PIXELS).astype('float32')
+# the bw network was trained on as_grey images in the 0-1 range
+X_train, _, _ = load_dataset('train', PIXELS, 'unit', grayscale=True)
 
 # load network weights
-f = gzip.open('data/weights/ResNet42_7x7_BN_ortho_bw_128_fold00_last.pklz', 'rb')
-all_params = pickle.load(f)
-f.close()
-helper.set_all_param_values(output_layer, all_params)
+load_params(output_layer, weights_filename('ResNet42_7x7_BN_ortho_bw_128_fold00', 'last'))
 
 #make predictions
 new_labels = []
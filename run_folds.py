@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import shlex
+import argparse
+import subprocess
+import multiprocessing
+from collections import deque
+
+'''
+Run a fold sweep across worker slots instead of one fold after another.
+
+Each fold runs the given steps in order, every step being a script and its arguments with
+--fold <fold> appended, so the per-fold label and weight names still come from
+argparsing.parse_args. A failed step is retried up to --retries times. Every slot gets its
+own Theano device (--devices gpu0 gpu1) or, on CPU-only boxes, an equal share of the cores
+(--slots 4), so several small-pixel folds can be packed onto one machine.
+
+    python run_folds.py --slots 2 --step "train_nn_pseudo.py --label ResNet82_5x5_BN_rgb_pseudo --pixels 128"
+    python run_folds.py --devices gpu0 gpu1 --step "train_nn_pseudo.py ..." --step "gen_pseudo_cascade.py ..."
+'''
+
+def parse_folds(spec):
+    '''
+    '0-9', '0,2,5' or a mix of both.
+    '''
+    folds = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            folds.extend(range(int(first), int(last) + 1))
+        else:
+            folds.append(int(part))
+    return folds
+
+def step_name(step):
+    '''
+    Label of a step for log names: its --label argument, or else the script name.
+    '''
+    argv = shlex.split(step)
+    for flag in ('--label', '-l'):
+        if flag in argv[:-1]:
+            return argv[argv.index(flag) + 1]
+    return os.path.splitext(os.path.basename(argv[0]))[0]
+
+def slot_env(slot, devices, threads):
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(threads)
+    env['MKL_NUM_THREADS'] = str(threads)
+    if devices:
+        flags = [f for f in env.get('THEANO_FLAGS', '').split(',') if f and not f.startswith('device=')]
+        env['THEANO_FLAGS'] = ','.join(flags + ['device=%s'%devices[slot]])
+    return env
+
+class FoldJob(object):
+    def __init__(self, fold):
+        self.fold = fold
+        self.step = 0
+        self.attempts = 0
+        self.runs = 0
+        self.elapsed = 0.
+        self.status = 'pending'
+
+def start_step(job, steps, slot, env, log_dir):
+    job.attempts += 1
+    job.runs += 1
+    job.started = time.time()
+    job.log = os.path.join(log_dir, '%s_fold%02d.log'%(step_name(steps[0]), job.fold))
+
+    argv = [sys.executable] + shlex.split(steps[job.step]) + ['--fold', str(job.fold)]
+    log = open(job.log, 'a')
+    log.write('\n==== slot %d | attempt %d | %s\n'%(slot, job.attempts, ' '.join(argv)))
+    log.flush()
+    print('fold %d: step %d of %d on slot %d (attempt %d)'%(job.fold, job.step + 1, len(steps), slot, job.attempts))
+    return subprocess.Popen(argv, stdout=log, stderr=subprocess.STDOUT, env=env), log
+
+def format_time(seconds):
+    return '%dh%02dm%02ds'%(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def print_summary(jobs):
+    print('')
+    print('%4s | %-22s | %4s | %10s | %s'%('fold', 'status', 'runs', 'time', 'log'))
+    print('-' * 80)
+    for job in jobs:
+        print('%4d | %-22s | %4d | %10s | %s'%(job.fold, job.status, job.runs, format_time(job.elapsed), getattr(job, 'log', '')))
+
+def run_folds(steps, folds, slots, devices=None, retries=1, threads=None, log_dir='logs', poll=5.):
+    '''
+    Run steps for every fold over slots worker slots and return the FoldJobs.
+    '''
+    if devices:
+        slots = len(devices)
+    threads = threads or max(multiprocessing.cpu_count() // slots, 1)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    jobs = [FoldJob(fold) for fold in folds]
+    pending = deque(jobs)
+    running = {}
+    try:
+        while pending or running:
+            for slot in range(slots):
+                if slot not in running and pending:
+                    job = pending.popleft()
+                    job.status = 'running'
+                    running[slot] = (job,) + start_step(job, steps, slot, slot_env(slot, devices, threads), log_dir)
+
+            time.sleep(poll)
+
+            for slot, (job, proc, log) in list(running.items()):
+                returncode = proc.poll()
+                if returncode is None:
+                    continue
+                log.close()
+                del running[slot]
+                job.elapsed += time.time() - job.started
+
+                if returncode == 0:
+                    job.step += 1
+                    if job.step < len(steps):
+                        # keep the slot for the rest of this fold, retries count per step
+                        job.attempts = 0
+                        running[slot] = (job,) + start_step(job, steps, slot, slot_env(slot, devices, threads), log_dir)
+                    else:
+                        job.status = 'ok'
+                        print('fold %d: done in %s'%(job.fold, format_time(job.elapsed)))
+                elif job.attempts <= retries:
+                    print('fold %d: step %d exited with %d, retrying'%(job.fold, job.step + 1, returncode))
+                    job.status = 'retrying'
+                    pending.append(job)
+                else:
+                    print('fold %d: step %d exited with %d, giving up'%(job.fold, job.step + 1, returncode))
+                    job.status = 'failed step %d (%d)'%(job.step + 1, returncode)
+    finally:
+        for job, proc, log in running.values():
+            proc.terminate()
+            log.close()
+            job.status = 'killed'
+
+    return jobs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run a fold sweep in parallel worker slots')
+    parser.add_argument('--step', type=str, action='append', required=True,
+                        help='script and arguments to run for each fold, --fold is appended; repeat for several steps')
+    parser.add_argument('--folds', type=str, default='0-9', help='folds, e.g. 0-9 or 0,3,5')
+    parser.add_argument('--slots', type=int, default=1, help='folds running at the same time')
+    parser.add_argument('--devices', type=str, nargs='*', default=None, help='one Theano device per slot, e.g. gpu0 gpu1')
+    parser.add_argument('--threads', type=int, default=None, help='threads per slot, defaults to an equal share of the cores')
+    parser.add_argument('--retries', type=int, default=1, help='retries of a failed step')
+    parser.add_argument('--log_dir', type=str, default='logs')
+    args = parser.parse_args()
+
+    jobs = run_folds(args.step, parse_folds(args.folds), args.slots, args.devices, args.retries, args.threads, args.log_dir)
+    print_summary(jobs)
+    sys.exit(0 if all(job.status == 'ok' for job in jobs) else 1)
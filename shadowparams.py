@@ -0,0 +1,174 @@
+import numpy as np
+
+import theano
+from lasagne.layers import helper
+
+'''
+On-device copies of the network parameters.
+
+Keeping the best epoch's weights with get_all_param_values copies every parameter to the
+host each time the validation score improves, seconds per epoch for the big networks.
+ShadowParams instead keeps a second set of shared variables next to the parameters and
+copies into them with a compiled function, so the copy never leaves the device. The host
+only sees the values when values() is called, at checkpoints and when the weights are
+saved.
+
+AverageParams keeps an exponential moving average of the parameters the same way,
+updated after every training batch by the function wrap() returns. SWAParams keeps the
+plain mean of the parameters at the end of the epochs it is updated in, e.g. the low
+learning rate tail of the schedule (stochastic weight averaging).
+
+Averaged weights come with running BatchNorm statistics that belong to none of the
+averaged networks, so refresh_batchnorm recomputes them with one forward pass over the
+training images before the average is saved.
+'''
+
+class ShadowParams(object):
+    def __init__(self, output_layer):
+        self.params = helper.get_all_params(output_layer)
+        self.shadow = [theano.shared(p.get_value(), broadcastable=p.broadcastable, name='shadow_%s'%p.name)
+                       for p in self.params]
+        self._copy = theano.function([], updates=zip(self.shadow, self.params))
+        self._restore = theano.function([], updates=zip(self.params, self.shadow))
+        self.empty = True
+
+    def copy(self):
+        '''
+        Copy the current parameters into the shadow.
+        '''
+        self._copy()
+        self.empty = False
+
+    def restore(self):
+        '''
+        Copy the shadow back into the parameters.
+        '''
+        self._restore()
+
+    def values(self):
+        '''
+        Host copies of the shadow, or None if nothing was copied yet.
+        '''
+        if self.empty:
+            return None
+        return [s.get_value() for s in self.shadow]
+
+    def set_values(self, values):
+        '''
+        Fill the shadow from host values, e.g. the ones a checkpoint saved.
+        '''
+        if values is None:
+            return
+        for s, value in zip(self.shadow, values):
+            s.set_value(value)
+        self.empty = False
+
+class AverageParams(ShadowParams):
+    def __init__(self, output_layer, decay=0.999):
+        super(AverageParams, self).__init__(output_layer)
+        # weight of the current parameters in an update, shared so SWAParams can change it
+        self.rate = theano.shared(np.cast[theano.config.floatX](1 - decay), name='average_rate')
+        updates = []
+        for s, p in zip(self.shadow, self.params):
+            if p.dtype.startswith('float'):
+                updates.append((s, (s + self.rate * (p - s)).astype(p.dtype)))
+            else:
+                updates.append((s, p))
+        self._update = theano.function([], updates=updates)
+        # the average starts from the parameters it was created with
+        self.empty = False
+
+    def update(self):
+        self._update()
+
+    def wrap(self, train_fn):
+        '''
+        train_fn followed by an update of the average, for the batch iterators.
+        '''
+        def train_and_average(*inputs):
+            loss = train_fn(*inputs)
+            self._update()
+            return loss
+        return train_and_average
+
+class SWAParams(AverageParams):
+    def __init__(self, output_layer):
+        super(SWAParams, self).__init__(output_layer)
+        self.count = 0
+        self.empty = True
+
+    def update(self):
+        '''
+        Add the current parameters to the mean.
+        '''
+        self.rate.set_value(np.cast[theano.config.floatX](1. / (self.count + 1)))
+        self._update()
+        self.count += 1
+        self.empty = False
+
+    def set_values(self, values, count=0):
+        super(SWAParams, self).set_values(values)
+        self.count = count if values is not None else 0
+
+# compiled refresh function and its shared alpha per network, so refreshing several averages compiles once
+_REFRESH_FNS = {}
+
+def refresh_function(output_layer):
+    '''
+    Function of a batch that updates the BatchNorm running averages of output_layer with weight
+    alpha, and the shared alpha. None if the network has no BatchNormLayer.
+    '''
+    import lasagne
+    from lasagne.layers import BatchNormLayer
+
+    if output_layer in _REFRESH_FNS:
+        return _REFRESH_FNS[output_layer]
+
+    layers = helper.get_all_layers(output_layer)
+    bn_layers = [l for l in layers if isinstance(l, BatchNormLayer)]
+    if not bn_layers:
+        _REFRESH_FNS[output_layer] = None, None
+        return None, None
+
+    # a shared alpha of 1/(batches so far + 1) turns the layers' running averages into plain means
+    alpha = theano.shared(np.cast[theano.config.floatX](1.), name='bn_refresh_alpha')
+    layer_alphas = [l.alpha for l in bn_layers]
+    for l in bn_layers:
+        l.alpha = alpha
+    try:
+        output = lasagne.layers.get_output(output_layer, deterministic=True,
+                                           batch_norm_use_averages=False, batch_norm_update_averages=True)
+        refresh_fn = theano.function([layers[0].input_var], output)
+    finally:
+        for l, layer_alpha in zip(bn_layers, layer_alphas):
+            l.alpha = layer_alpha
+
+    _REFRESH_FNS[output_layer] = refresh_fn, alpha
+    return refresh_fn, alpha
+
+def refresh_batchnorm(output_layer, data, batchsize):
+    '''
+    Set the running mean and inv_std of every BatchNormLayer to their mean over the full batches
+    of data, with dropout off. Returns the number of batches used.
+    '''
+    refresh_fn, alpha = refresh_function(output_layer)
+    if refresh_fn is None:
+        return 0
+
+    n_batches = max(data.shape[0] // batchsize, 1)
+    for i in range(n_batches):
+        alpha.set_value(np.cast[theano.config.floatX](1. / (i + 1)))
+        refresh_fn(data[i * batchsize:(i + 1) * batchsize])
+    return n_batches
+
+def save_average(output_layer, average, filename, data, batchsize):
+    '''
+    Load an average into the network, refresh its BatchNorm statistics on data and save it.
+    The network keeps the averaged weights.
+    '''
+    from weightstore import save_params
+
+    average.restore()
+    n_batches = refresh_batchnorm(output_layer, data, batchsize)
+    save_params(output_layer, filename)
+    print('Saved %s, BatchNorm statistics from %d batches'%(filename, n_batches))
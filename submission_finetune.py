@@ -26,13 +26,18 @@ from skimage import transform, filters, exposure
 
 from models import ResNet_FullPre, ResNet_FullPre_Wide, ST_ResNet_FullPre, bvlc_googlenet_submission
 from utils import load_test, batch_iterator_train, batch_iterator_valid
+from datacache import list_images, normalize_batch, stream_image_batches
+from predstore import prediction_filename, save_predictions
+from dataset import IMAGENET_MEAN
+from compilecache import compiled_functions
+from weightstore import load_params, weights_filename
 
 import argparsing
 args, unknown_args = argparsing.parse_args()
 
 experiment_label = args.label
 PIXELS = args.pixels
-BATCHSIZE = 1
+BATCHSIZE = args.batchsize
 
 imageSize = PIXELS * PIXELS
 num_features = imageSize * 3
@@ -46,43 +51,65 @@ Y = T.ivector('y')
 # set up theano functions to generate output by feeding data through network, any test outputs should be deterministic
 output_layer = bvlc_googlenet_submission(X)
 
-output_test = lasagne.layers.get_output(output_layer, deterministic=True)
+def build_predict_functions():
+    output_test = lasagne.layers.get_output(output_layer, deterministic=True)
 
-# set up training and prediction functions
-predict_proba = theano.function(inputs=[X], outputs=output_test)
+    # set up training and prediction functions
+    predict_proba = theano.function(inputs=[X], outputs=output_test)
+
+    return {'predict_proba': predict_proba}
+
+functions = compiled_functions(output_layer, build_predict_functions, 'bvlc_googlenet_submission', PIXELS,
+                               enabled=not args.no_compile_cache)
+output_layer = functions['output_layer']
+predict_proba = functions['predict_proba']
 
 
 # load network weights
-f = gzip.open('data/weights/%s_last.pklz'%experiment_label, 'rb')
-#f = gzip.open('data/weights/%s.pklz'%experiment_label, 'rb')
-all_params = pickle.load(f)
-f.close()
-helper.set_all_param_values(output_layer, all_params)
+load_params(output_layer, weights_filename(experiment_label, args.weights))
 
 
 
-#make predictions
-predictions = []
-# load each image
-path = os.path.join('data', 'imgs', 'test', '*.jpg')
-files = glob.glob(path)
-for fl in files:
-    flbase = os.path.basename(fl)
-    img = imread(fl)
-    img = transform.resize(img, output_shape=(PIXELS, PIXELS, 3), preserve_range=True)
-    img = img.transpose(2, 0, 1)
-    img = img.astype('float32')
-
-    img_pred = np.ones(shape=(1,3,224,224), dtype='float32')
-    img_pred[0] = img
-    img_pred = img_pred[:, [2,1,0], :, :]
-
-    mean_pixel = [103.939, 116.779, 123.68]
-    for c in range(3):
-        img_pred[:, c, :, :] = img_pred[:, c, :, :] - mean_pixel[c]
-
-    predictions.extend(predict_proba(img_pred))
+def predict_streaming(files, filename):
+    '''
+    Predict files in batches while background workers decode the next ones, writing each batch
+    into a memory-mapped .npy as soon as it is predicted. Rows that are still NaN have not been
+    predicted, so running again after a crash resumes from the first of them.
+    '''
+    n_files = len(files)
+    id_filename = filename.replace('.npy', '_files.npy')
+
+    if os.path.isfile(filename) and os.path.isfile(id_filename) and np.array_equal(np.load(id_filename), files):
+        predictions = np.load(filename, mmap_mode='r+')
+    else:
+        np.save(id_filename, np.array(files))
+        predictions = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(n_files, 10))
+        predictions[:] = np.nan
+
+    todo = np.isnan(predictions).any(axis=1)
+    start = np.argmax(todo) if todo.any() else n_files
+    if start > 0:
+        print('Resuming %s at image %d of %d'%(filename, start, n_files))
+
+    t = time.time()
+    for offset, X_batch in stream_image_batches(files, PIXELS, BATCHSIZE, workers=args.workers, start=start):
+        # swap to BGR and subtract the ImageNet channel means in one pass
+        X_batch = normalize_batch(X_batch, IMAGENET_MEAN, channel_order=[2,1,0])
+        predictions[offset:offset + X_batch.shape[0]] = predict_proba(X_batch)
+        predictions.flush()
+        if (offset // BATCHSIZE)%50 == 0:
+            print('%d of %d | %.1f img/s'%(offset + X_batch.shape[0], n_files, (offset + X_batch.shape[0] - start) / (time.time() - t)))
 
+    elapsed = time.time() - t
+    print('Predicted %d images in %.1fs (%.1f img/s)'%(n_files - start, elapsed, (n_files - start) / max(elapsed, 1e-8)))
+
+    return np.array(predictions)
+
+#make predictions
+if not os.path.isdir('data/preds'):
+    os.makedirs('data/preds')
+files, _, test_id = list_images(os.path.join('data', 'imgs', 'test'))
+predictions = predict_streaming(files, 'data/preds/%s_finetune_test.npy'%experiment_label)
 predictions = np.array(predictions)
 print predictions.shape
 
@@ -200,22 +227,9 @@ tta_sub_10 = np.load('data/tta_temp/predictions_tta_10.npy')
 
 predictions = (tta_sub_1 + tta_sub_2 + tta_sub_3 + tta_sub_4 + tta_sub_5 + tta_sub_6 + tta_sub_7 + tta_sub_8 + tta_sub_9 + tta_sub_10) / 10.0
 '''
-test_id = np.load('data/cache/X_test_id_%d_f32.npy'%PIXELS)
 
 '''
-Make submission file
+Save predictions
 '''
-print 'Generating submission for', str(experiment_label)
-
-
-def create_submission(predictions, test_id):
-    result1 = pd.DataFrame(predictions, columns=['c0', 'c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7', 'c8', 'c9'])
-    result1.loc[:, 'img'] = pd.Series(test_id, index=result1.index)
-    now = datetime.datetime.now()
-    if not os.path.isdir('subm'):
-        os.mkdir('subm')
-    suffix = str(now.strftime("%Y-%m-%d-%H-%M"))
-    sub_file = os.path.join('subm', '%s_finetune.csv'%experiment_label)
-    result1.to_csv(sub_file, index=False)
-
-create_submission(predictions, test_id)
+print 'Saving predictions for', str(experiment_label)
+save_predictions(prediction_filename(experiment_label, 'finetune'), predictions, test_id)
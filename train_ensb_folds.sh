@@ -1,6 +1,5 @@
 #!/bin/bash
 
-for i in {0..9}
-do
-    python train_nn_pseudo.py --label ResNet82_5x5_BN_rgb_pseudo --pixels 128 --fold $i --batchsize 64
-done
+# SLOTS folds at a time, e.g. SLOTS=4 ./train_ensb_folds.sh to pack 128 px folds onto one CPU box
+python run_folds.py --slots ${SLOTS:-1} --folds 0-9 \
+    --step "train_nn_pseudo.py --label ResNet82_5x5_BN_rgb_pseudo --pixels 128 --batchsize 64"
@@ -15,8 +15,14 @@ from sklearn.preprocessing import LabelEncoder, LabelBinarizer
 from sklearn.metrics import confusion_matrix
 
 from models import ResNet_FullPre, ResNet_FullPre_Wide, ResNet_FullPre_Trans
-from utils import load_train_cv, batch_iterator_train, batch_iterator_valid, load_pseudo, batch_iterator_train_noaug
-from crossvalidation import load_cv_fold
+from utils import load_train_cv, batch_iterator_train, batch_iterator_valid_proba, load_pseudo, batch_iterator_train_noaug
+from utils import PrefetchLoader, batch_iterator_train_prefetch, auto_batchsize
+from crossvalidation import load_cv_fold, cv_ids
+from predstore import save_oof
+from compilecache import compiled_functions
+from checkpoint import Checkpointer
+from weightstore import save_params, weights_filename
+from shadowparams import ShadowParams, AverageParams, SWAParams, save_average
 
 from matplotlib import pyplot
 import warnings
@@ -47,40 +53,47 @@ Y = T.ivector('y')
 
 # set up theano functions to generate output by feeding data through network, any test outputs should be deterministic
 # load model
-output_layer = ResNet_FullPre_Wide(X, n=2, k=3)
+output_layer = ResNet_FullPre_Wide(X, n=2, k=3, pixels=PIXELS)
 
-# create outputs
-output_train = lasagne.layers.get_output(output_layer)
-output_test = lasagne.layers.get_output(output_layer, deterministic=True)
-output_class = T.argmax(output_test, axis=1)
+def build_train_functions():
+    # create outputs
+    output_train = lasagne.layers.get_output(output_layer)
+    output_test = lasagne.layers.get_output(output_layer, deterministic=True)
 
-# set up the loss that we aim to minimize when using cat cross entropy our Y should be ints not one-hot
-loss = lasagne.objectives.categorical_crossentropy(output_train, Y)
-loss = loss.mean()
+    # set up the loss that we aim to minimize when using cat cross entropy our Y should be ints not one-hot
+    loss = lasagne.objectives.categorical_crossentropy(output_train, Y)
+    loss = loss.mean()
 
-# if using ResNet use L2 regularization
-all_layers = lasagne.layers.get_all_layers(output_layer)
-l2_penalty = lasagne.regularization.regularize_layer_params(all_layers, lasagne.regularization.l2) * 0.0001
-loss = loss + l2_penalty
+    # if using ResNet use L2 regularization
+    all_layers = lasagne.layers.get_all_layers(output_layer)
+    l2_penalty = lasagne.regularization.regularize_layer_params(all_layers, lasagne.regularization.l2) * 0.0001
+    loss = loss + l2_penalty
 
-# set up loss functions for validation dataset
-test_loss = lasagne.objectives.categorical_crossentropy(output_test, Y)
-test_loss = test_loss.mean()
+    # set up loss functions for validation dataset
+    test_loss = lasagne.objectives.categorical_crossentropy(output_test, Y)
+    test_loss = test_loss.mean()
 
-test_acc = T.mean(T.eq(T.argmax(output_test, axis=1), Y), dtype=theano.config.floatX)
+    test_acc = T.mean(T.eq(T.argmax(output_test, axis=1), Y), dtype=theano.config.floatX)
 
-# prediction function for confusion_matrix
-predict_class = theano.function(inputs=[X], outputs=output_class)
+    # get parameters from network and set up sgd with nesterov momentum to update parameters, l_r is shared var so it can be changed
+    l_r = theano.shared(np.array(LR_SCHEDULE[0], dtype=theano.config.floatX))
+    params = lasagne.layers.get_all_params(output_layer, trainable=True)
+    #updates = nesterov_momentum(loss, params, learning_rate=l_r, momentum=0.9)
+    updates = adam(loss, params, learning_rate=l_r)
 
-# get parameters from network and set up sgd with nesterov momentum to update parameters, l_r is shared var so it can be changed
-l_r = theano.shared(np.array(LR_SCHEDULE[0], dtype=theano.config.floatX))
-params = lasagne.layers.get_all_params(output_layer, trainable=True)
-#updates = nesterov_momentum(loss, params, learning_rate=l_r, momentum=0.9)
-updates = adam(loss, params, learning_rate=l_r)
+    # set up training and prediction functions
+    train_fn = theano.function(inputs=[X,Y], outputs=loss, updates=updates)
+    # one validation pass gives the loss, accuracy and the probabilities for the out-of-fold predictions and confusion_matrix
+    valid_fn = theano.function(inputs=[X,Y], outputs=[test_loss, test_acc, output_test])
 
-# set up training and prediction functions
-train_fn = theano.function(inputs=[X,Y], outputs=loss, updates=updates)
-valid_fn = theano.function(inputs=[X,Y], outputs=[test_loss, test_acc])
+    return {'train_fn': train_fn, 'valid_fn': valid_fn, 'l_r': l_r}
+
+functions = compiled_functions(output_layer, build_train_functions, 'ResNet_FullPre_Wide', PIXELS, 'categorical_crossentropy+l2',
+                               enabled=not args.no_compile_cache, targets='int', updates='adam')
+output_layer = functions['output_layer']
+train_fn = functions['train_fn']
+valid_fn = functions['valid_fn']
+l_r = functions['l_r']
 
 '''
 load training data and start training
@@ -88,29 +101,57 @@ load training data and start training
 
 # load the training and validation data sets
 #train_X, train_y, test_X, test_y, encoder = load_train_cv(encoder, cache=True, relabel=False)
-train_X, train_y, test_X, test_y, encoder = load_cv_fold(encoder, args.fold)
+train_X, train_y, test_X, test_y, encoder = load_cv_fold(encoder, PIXELS, args.fold, random_state=np.random.RandomState([args.seed, args.fold]))
 print 'Train shape:', train_X.shape, 'Test shape:', test_X.shape
 print 'Train y shape:', train_y.shape, 'Test y shape:', test_y.shape
-print np.amax(train_X), np.amin(train_X), np.mean(train_X)
+print np.amax(train_X[:BATCHSIZE]), np.amin(train_X[:BATCHSIZE]), np.mean(train_X[:BATCHSIZE])
+
+# augment batches in background workers while the network trains
+loader = PrefetchLoader(train_X, train_y, BATCHSIZE, workers=args.workers, seed=args.seed, aug_mode=args.aug_mode)
+
+VALID_BATCH = args.valid_batchsize or auto_batchsize(valid_fn, test_X, test_y, BATCHSIZE)
+print 'Valid batch size:', VALID_BATCH
 
 # loop over training functions for however many iterations, print information while training
 train_eval = []
 valid_eval = []
 valid_acc = []
 best_vl = 3.0
+# the best weights and the averages stay on the device, host copies are only made at checkpoints
+best_weights = ShadowParams(output_layer)
+average_weights = AverageParams(output_layer, args.ema_decay) if args.ema_decay else None
+swa_weights = SWAParams(output_layer) if args.swa_start else None
+train_step = average_weights.wrap(train_fn) if average_weights is not None else train_fn
+
+# resume from the last checkpoint of this run, if there is one
+checkpointer = Checkpointer(experiment_label, train_fn, args.run_id)
+first_epoch = 0
+resumed = None if args.restart else checkpointer.load()
+if resumed is not None:
+    first_epoch, history = resumed
+    train_eval, valid_eval, valid_acc = history['train_eval'], history['valid_eval'], history['valid_acc']
+    best_vl = history['best_vl']
+    best_weights.set_values(history['best_params'])
+    if average_weights is not None:
+        average_weights.set_values(history.get('ema_params'))
+    if swa_weights is not None:
+        swa_weights.set_values(history.get('swa_params'), history.get('swa_count', 0))
+    valid_proba = history['valid_proba']
+
+completed = False
 try:
-    for epoch in range(ITERS):
+    for epoch in range(first_epoch, ITERS):
         # change learning rate according to schedules
         if epoch in LR_SCHEDULE:
             l_r.set_value(LR_SCHEDULE[epoch])
         # do the training
         start = time.time()
 
-        train_loss = batch_iterator_train(train_X, train_y, BATCHSIZE, train_fn)
+        train_loss = batch_iterator_train_prefetch(loader, epoch, train_step)
         #train_loss = batch_iterator_train_noaug(train_X, train_y, BATCHSIZE, train_fn)
         train_eval.append(train_loss)
 
-        valid_loss, acc_v = batch_iterator_valid(test_X, test_y, 4, valid_fn)
+        valid_loss, acc_v, valid_proba = batch_iterator_valid_proba(test_X, test_y, VALID_BATCH, valid_fn)
         valid_eval.append(valid_loss)
         valid_acc.append(acc_v)
 
@@ -121,22 +162,41 @@ try:
 
         if valid_loss < best_vl:
             best_vl = valid_loss
-            best_params = helper.get_all_param_values(output_layer)
+            best_weights.copy()
+
+        # stochastic weight averaging over the tail of the schedule
+        if swa_weights is not None and epoch >= args.swa_start:
+            swa_weights.update()
 
+        if args.checkpoint_every and (epoch + 1)%args.checkpoint_every == 0:
+            checkpointer.save(epoch + 1, train_eval=list(train_eval), valid_eval=list(valid_eval), valid_acc=list(valid_acc),
+                              best_vl=best_vl, best_params=best_weights.values(),
+                              ema_params=average_weights.values() if average_weights is not None else None,
+                              swa_params=swa_weights.values() if swa_weights is not None else None,
+                              swa_count=swa_weights.count if swa_weights is not None else 0, valid_proba=valid_proba)
+
+    completed = True
 except KeyboardInterrupt:
     pass
 
+loader.close()
+
 print "Best Valid Loss:", best_vl
 
 # save weights
-f = gzip.open('data/weights/%s_best.pklz'%experiment_label, 'wb')
-pickle.dump(best_params, f)
-f.close()
-
-last_params = helper.get_all_param_values(output_layer)
-f = gzip.open('data/weights/%s_last.pklz'%experiment_label, 'wb')
-pickle.dump(last_params, f)
-f.close()
+save_params(output_layer, weights_filename(experiment_label, 'best'), best_weights.values())
+save_params(output_layer, weights_filename(experiment_label, 'last'))
+# averaged weights get BatchNorm statistics of their own, this leaves the network averaged
+if average_weights is not None:
+    save_average(output_layer, average_weights, weights_filename(experiment_label, 'ema'), train_X, BATCHSIZE)
+if swa_weights is not None and not swa_weights.empty:
+    save_average(output_layer, swa_weights, weights_filename(experiment_label, 'swa'), train_X, BATCHSIZE)
+
+if completed:
+    # the run is done, a later run with this label starts from scratch
+    checkpointer.remove()
+else:
+    checkpointer.wait()
 
 # plot loss and accuracy
 train_eval = np.array(train_eval)
@@ -157,30 +217,29 @@ pyplot.savefig('plots/%s.png'%experiment_label)
 pyplot.clf()
 #pyplot.show()
 
-#make predictions
-TEST_BATCH = 1
-new_labels = []
-for j in range((test_X.shape[0] + TEST_BATCH - 1) // TEST_BATCH):
-    sl = slice(j * TEST_BATCH, (j + 1) * TEST_BATCH)
-    X_batch = test_X[sl]
-    new_labels.extend(predict_class(X_batch))
-
-new_labels = np.array(new_labels)
-print new_labels.shape
-
-labels = [
-    'safe driving',
-    'texting - right',
-    'talking on the phone - right',
-    'texting - left',
-    'talking on the phone - left',
-    'operating the radio',
-    'drinking',
-    'reaching behind',
-    'hair and makeup',
-    'talking to passenger']
-
-pyplot.matshow(confusion_matrix(test_y, new_labels), cmap='Reds', interpolation='none')
-pyplot.yticks(np.arange(10), labels)
-pyplot.xticks(np.arange(10), labels, rotation=90)
-pyplot.savefig('plots/%s_confusion.png'%experiment_label)
+# out-of-fold predictions of the held out drivers from the last validation pass, into the rows of X_data shared by all folds.
+# an interrupted run has none yet or those of a part-trained network, which would pass as the run's in the ensemble
+if not completed:
+    print 'Interrupted, no out-of-fold predictions saved'
+else:
+    save_oof(args.experiment, test_X.index, valid_proba, cv_ids(), args.run_id)
+    print 'Out-of-fold predictions:', valid_proba.shape
+
+    new_labels = np.argmax(valid_proba, axis=1)
+
+    labels = [
+        'safe driving',
+        'texting - right',
+        'talking on the phone - right',
+        'texting - left',
+        'talking on the phone - left',
+        'operating the radio',
+        'drinking',
+        'reaching behind',
+        'hair and makeup',
+        'talking to passenger']
+
+    pyplot.matshow(confusion_matrix(test_y, new_labels), cmap='Reds', interpolation='none')
+    pyplot.yticks(np.arange(10), labels)
+    pyplot.xticks(np.arange(10), labels, rotation=90)
+    pyplot.savefig('plots/%s_confusion.png'%experiment_label)
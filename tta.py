@@ -0,0 +1,173 @@
+import os
+import time
+import numpy as np
+
+from augmentation import AugmentationEngine
+
+'''
+Test time augmentation.
+
+run_tta predicts the test set passes times under random pad-and-crop augmentation and keeps
+a running per-image, per-class mean and variance of the predictions in memory (Welford's
+algorithm), instead of saving every pass to disk and adding the files up afterwards.
+With a checkpoint file the statistics are saved after every pass, so an interrupted run
+resumes at the next pass and parallel runs never share files. The checkpoint records the
+seed, the number of passes and the padding, a run with other settings refuses to resume
+from it, and it is removed once all passes are done.
+
+run_tta_grid is the deterministic alternative: each batch is padded once and a fixed grid
+of crops is taken from it as strided views, optionally plus a few small rotations.
+'''
+
+class RunningStats(object):
+    '''
+    Streaming mean and variance of a sequence of same-shaped prediction arrays.
+    '''
+    def __init__(self, shape):
+        self.count = 0
+        self.meta = {}
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    def update(self, predictions):
+        self.count += 1
+        delta = predictions - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (predictions - self.mean)
+
+    def set_rows(self, sl, predictions):
+        '''
+        Fill rows sl from all of their (passes, rows, classes) predictions at once.
+        '''
+        self.count = predictions.shape[0]
+        self.mean[sl] = predictions.mean(axis=0)
+        self.m2[sl] = ((predictions - self.mean[sl]) ** 2).sum(axis=0)
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    def save(self, filename, **meta):
+        '''
+        Save the statistics and meta, e.g. the settings of the run that produced them.
+        '''
+        # write then rename so a crash mid-save keeps the previous checkpoint
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(tmp_filename, count=self.count, mean=self.mean, m2=self.m2, **meta)
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        d = np.load(filename)
+        stats = cls(d['mean'].shape)
+        stats.count = int(d['count'])
+        stats.mean[:] = d['mean']
+        stats.m2[:] = d['m2']
+        stats.meta = dict((k, d[k].item()) for k in d.files if k not in ('count', 'mean', 'm2'))
+        return stats
+
+def random_crop_batch(X_batch, pad_crop, rng=np.random, pad_mode='constant'):
+    '''
+    Pad the whole batch by pad_crop on every side and take one random crop of the original size,
+    the same offset for every image.
+    '''
+    pixels = X_batch.shape[-1]
+    X_pad = np.pad(X_batch, pad_width=((0,0), (0,0), (pad_crop,pad_crop), (pad_crop,pad_crop)), mode=pad_mode)
+    crop_x1, crop_y1 = rng.randint(0, (pad_crop*2) + 1, size=2)
+    return X_pad[:, :, crop_x1:crop_x1 + pixels, crop_y1:crop_y1 + pixels]
+
+def crop_grid(pad_crop, size=3):
+    '''
+    size x size crop offsets spread evenly over the padded border, including the center crop when size is odd.
+    '''
+    steps = np.unique(np.round(np.linspace(0, 2 * pad_crop, size)).astype(int))
+    return [(crop_x1, crop_y1) for crop_x1 in steps for crop_y1 in steps]
+
+def grid_views(X_batch, offsets, pad_crop, pad_mode='constant', rotations=(), engine=None):
+    '''
+    Yield the TTA views of a batch: one strided crop view of the batch, padded once, per offset,
+    then the center crop rotated by each angle in rotations with engine (reflect padded).
+    '''
+    pixels = X_batch.shape[-1]
+    X_pad = np.pad(X_batch, pad_width=((0,0), (0,0), (pad_crop,pad_crop), (pad_crop,pad_crop)), mode=pad_mode)
+    for crop_x1, crop_y1 in offsets:
+        yield X_pad[:, :, crop_x1:crop_x1 + pixels, crop_y1:crop_y1 + pixels]
+
+    for rotate in rotations:
+        params = {'zoom': np.ones(1), 'shear': np.zeros(1), 'rotate': np.array([rotate]),
+                  'crop': np.array([[pad_crop, pad_crop]]), 'intensity_channels': np.zeros((1, 3), dtype=int),
+                  'intensity': np.zeros(1, dtype=int), 'bright': np.ones(1)}
+        yield engine(X_batch, params)
+
+def report_variance(stats, ids=None, top=5):
+    '''
+    Print how much the predictions moved across passes: the per-image variance, averaged over classes.
+    '''
+    image_var = stats.variance.mean(axis=1)
+    print('tta: %d passes | per-image variance mean %.2e | median %.2e | max %.2e'%(
+          stats.count, image_var.mean(), np.median(image_var), image_var.max()))
+    if ids is not None:
+        for i in np.argsort(image_var)[::-1][:top]:
+            print('    %s %.2e'%(ids[i], image_var[i]))
+    return image_var
+
+def run_tta(predict_fn, X_test, batchsize, pad_crop, passes=20, checkpoint=None, seed=0, pad_mode='constant'):
+    '''
+    Average predict_fn over passes random pad-and-crop augmentations of X_test and return the
+    RunningStats. Pass i draws its crops from RandomState([seed, i]), so resuming from checkpoint
+    gives the same result as an uninterrupted run. Raises ValueError if the checkpoint was written
+    with another seed, number of passes or pad_mode. The checkpoint is removed when the run is done.
+    '''
+    settings = {'seed': seed, 'passes': passes, 'pad_mode': pad_mode}
+    stats = None
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        stats = RunningStats.load(checkpoint)
+        if stats.meta != settings:
+            raise ValueError('%s was written by a TTA run with %s, not %s, remove it to start over'%(checkpoint, stats.meta, settings))
+        print('Resuming TTA from %s after %d passes'%(checkpoint, stats.count))
+
+    n_samples = X_test.shape[0]
+    first = 0 if stats is None else stats.count
+    for tta_iter in range(first, passes):
+        start = time.time()
+        rng = np.random.RandomState([seed, tta_iter])
+        predictions = []
+        for i in range((n_samples + batchsize - 1) // batchsize):
+            sl = slice(i * batchsize, (i + 1) * batchsize)
+            predictions.extend(predict_fn(random_crop_batch(X_test[sl], pad_crop, rng, pad_mode)))
+        predictions = np.array(predictions)
+
+        if stats is None:
+            stats = RunningStats(predictions.shape)
+        stats.update(predictions)
+        if checkpoint is not None:
+            stats.save(checkpoint, **settings)
+        print('tta pass %d of %d took %.1fs'%(tta_iter + 1, passes, time.time() - start))
+
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        # finished, a later run with the same name starts over
+        os.remove(checkpoint)
+    return stats
+
+def run_tta_grid(predict_fn, X_test, batchsize, pad_crop, offsets, rotations=(), pad_mode='constant'):
+    '''
+    Deterministic TTA: predict every view from grid_views for each batch and return the RunningStats
+    over the views. Every batch is padded once and the views are fed to predict_fn directly.
+    '''
+    engine = None
+    if len(rotations):
+        engine = AugmentationEngine(X_test.shape[-1], pad_crop)
+
+    n_samples = X_test.shape[0]
+    stats = None
+    start = time.time()
+    for i in range((n_samples + batchsize - 1) // batchsize):
+        sl = slice(i * batchsize, (i + 1) * batchsize)
+        predictions = np.array([predict_fn(view) for view in grid_views(X_test[sl], offsets, pad_crop, pad_mode, rotations, engine)])
+
+        if stats is None:
+            stats = RunningStats((n_samples,) + predictions.shape[2:])
+        stats.set_rows(sl, predictions)
+    print('tta grid of %d views took %.1fs'%(stats.count, time.time() - start))
+
+    return stats
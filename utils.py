@@ -1,270 +1,105 @@
 import os
 import glob
 import math
+import time
 import random
+import multiprocessing
 import numpy as np
+from collections import deque
 
-from sklearn.utils import shuffle
-from sklearn.preprocessing import LabelBinarizer
-from sklearn.cross_validation import train_test_split
-from sklearn.manifold import TSNE
+from dataset import load_dataset, cache_filenames
+from datacache import manifest_filename
+from predstore import align_rows, aligned_predictions
 
-from matplotlib import pyplot
-from skimage.io import imshow, imsave, imread
-from skimage.util import crop
-from skimage import transform, filters, exposure, img_as_ubyte
+'''
+Loaders and batch iterators shared by the training and prediction scripts.
 
-import theano
-from theano import tensor as T
+Nothing here reads the command line: the image size is passed in by the caller (or taken
+from the batch), and sklearn, skimage, matplotlib and keras are imported inside the
+functions that use them, so importing utils in a loader worker or a small tool is cheap.
+'''
 
-import argparsing
-args, unknown_args = argparsing.parse_args()
+# AugmentationEngine per (pixels, mode), built on first use in each process
+_AUGMENTATION = {}
 
-PIXELS = args.pixels
-PAD_CROP = int(PIXELS * 0.21875)
-PAD_PIXELS = PIXELS + (PAD_CROP * 2)
-imageSize = PIXELS * PIXELS
-num_features = imageSize * 3
+def augmentation_engine(pixels, mode='batch'):
+    if (pixels, mode) not in _AUGMENTATION:
+        from augmentation import AugmentationEngine
+        _AUGMENTATION[pixels, mode] = AugmentationEngine(pixels, int(pixels * 0.21875), mode=mode)
+    return _AUGMENTATION[pixels, mode]
 
-def load_train_cv(encoder, cache=False):
-    if cache:
-        X_train = np.load('data/cache/X_train_%d_f32_clean.npy'%PIXELS)
-        y_train = np.load('data/cache/y_train_%d_f32_clean.npy'%PIXELS)
-    else:
-        X_train = []
-        y_train = []
-        X_train_id = []
-        print('Read train images')
-        for j in range(10):
-            print('Load folder c{}'.format(j))
-            path = os.path.join('data', 'imgs', 'train_cleaned', 'c' + str(j), '*.jpg')
-            files = glob.glob(path)
-            for fl in files:
-                print fl
-                flbase = os.path.basename(fl)
-                img = imread(fl)
-                img = transform.resize(img, output_shape=(PIXELS, PIXELS, 3), preserve_range=True)
-                img = img.transpose(2, 0, 1)
-                img = np.reshape(img, (1, num_features))
-                X_train.append(img)
-                y_train.append(j)
-                X_train_id.append('c' + str(j) + '/' + str(flbase))
-
-        X_train = np.array(X_train, dtype='float32')
-        y_train = np.array(y_train)
-        X_train_id = np.array(X_train_id)
-
-        np.save('data/cache/X_train_%d_f32_clean.npy'%PIXELS, X_train)
-        np.save('data/cache/y_train_%d_f32_clean.npy'%PIXELS, y_train)
-        np.save('data/cache/X_train_id_%d_f32_clean.npy'%PIXELS, X_train_id)
-
-    y_train = encoder.fit_transform(y_train).astype('int32')
+def load_train_cv(encoder, pixels, cache=False, normalization=None, random_state=None):
+    from sklearn.utils import shuffle
+    from sklearn.cross_validation import train_test_split
 
-    X_train, y_train = shuffle(X_train, y_train)
+    X_all, y_train, _ = load_dataset('train_cleaned', pixels, normalization, cache=cache)
 
-    X_train, X_test, y_train, y_test = train_test_split(X_train, y_train, test_size=0.15)
+    y_train = encoder.fit_transform(y_train).astype('int32')
 
-    X_train = X_train.reshape(X_train.shape[0], 3, PIXELS, PIXELS)
-    X_test = X_test.reshape(X_test.shape[0], 3, PIXELS, PIXELS)
+    # split indices into the cache rather than copying the images
+    # a fixed random_state gives the same split every run, e.g. when resuming from a checkpoint
+    train_index, y_train = shuffle(np.arange(X_all.shape[0]), y_train, random_state=random_state)
 
-    # pixels of 224 are only used for finetuning pretrained networks so we use ImageNet channel means
-    if PIXELS == 224:
-        # swap to BGR
-        for image in range(X_train.shape[0]):
-            X_train[image] = X_train[image, [2,1,0], :, :]
-        for image in range(X_test.shape[0]):
-            X_test[image] = X_test[image, [2,1,0], :, :]
+    train_index, test_index, y_train, y_test = train_test_split(train_index, y_train, test_size=0.15, random_state=random_state)
 
-        mean_pixel = [103.939, 116.779, 123.68]
-        for c in range(3):
-            X_train[:, c, :, :] = X_train[:, c, :, :] - mean_pixel[c]
-            X_test[:, c, :, :] = X_test[:, c, :, :] - mean_pixel[c]
+    return X_all.subset(train_index), y_train, X_all.subset(test_index), y_test, encoder
 
-    else:
-        # subtract per-pixel mean
-        #pixel_mean = np.mean(X_train, axis=0)
-        #np.save('data/pixel_mean_full_%d.npy'%PIXELS, pixel_mean)
-        pixel_mean = np.load('data/pixel_mean_full_%d.npy'%PIXELS)
-        X_train -= pixel_mean
-        X_test -= pixel_mean
-
-    return X_train, y_train, X_test, y_test, encoder
-
-def load_train(encoder, cache=False, relabel=False):
-    if cache:
-        X_train = np.load('data/cache/X_train_%d_f32.npy'%PIXELS)
-        if relabel:
-            y_train = np.load('data/cache/y_train_%d_f32_relabel.npy'%PIXELS)
-        else:
-            y_train = np.load('data/cache/y_train_%d_f32.npy'%PIXELS)
-    else:
-        X_train = []
-        y_train = []
-        print('Read train images')
-        for j in range(10):
-            print('Load folder c{}'.format(j))
-            path = os.path.join('data', 'imgs', 'train', 'c' + str(j), '*.jpg')
-            files = glob.glob(path)
-            for fl in files:
-                print(fl)
-                img = imread(fl)
-                img = transform.resize(img, output_shape=(PIXELS, PIXELS, 3), preserve_range=True)
-                img = img.transpose(2, 0, 1)
-                img = np.reshape(img, (1, num_features))
-                X_train.append(img)
-                y_train.append(j)
-
-        X_train = np.array(X_train, dtype='float32')
-        y_train = np.array(y_train)
-
-        np.save('data/cache/X_train_%d_f32.npy'%PIXELS, X_train)
-        np.save('data/cache/y_train_%d_f32.npy'%PIXELS, y_train)
+def load_train(encoder, pixels, cache=False, relabel=False, normalization=None):
+    X_train, y_train, _ = load_dataset('train', pixels, normalization, cache=cache, mean_file='data/pixel_mean.npy')
+    if relabel:
+        y_train = np.load('data/cache/y_train_%d_f32_relabel.npy'%pixels)
 
     y_train = encoder.fit_transform(y_train).astype('int32')
 
-    X_train = X_train.reshape(X_train.shape[0], 3, PIXELS, PIXELS)
-
-    # subtract pixel mean
-    #pixel_mean = np.mean(X_train, axis=0)
-    #np.save('data/pixel_mean_full_%d.npy'%PIXELS, pixel_mean)
-    pixel_mean = np.load('data/pixel_mean.npy')
-    X_train -= pixel_mean
-
     return X_train, y_train, encoder
 
-def load_test(cache=False, size=PIXELS):
-    if cache:
-        X_test = np.load('data/cache/X_test_%d_f32.npy'%PIXELS)
-        X_test_id = np.load('data/cache/X_test_id_%d_f32.npy'%PIXELS)
-    else:
-        print('Read test images')
-        path = os.path.join('data', 'imgs', 'test', '*.jpg')
-        files = glob.glob(path)
-        X_test = []
-        X_test_id = []
-        for fl in files:
-            print(fl)
-            flbase = os.path.basename(fl)
-            img = imread(fl)
-            img = transform.resize(img, output_shape=(PIXELS, PIXELS, 3), preserve_range=True)
-            img = img.transpose(2, 0, 1)
-            img = np.reshape(img, (1, num_features))
-            if PIXELS == 224:
-                img = img.astype('float16')
-            X_test.append(img)
-            X_test_id.append(flbase)
-
-        if PIXELS == 224:
-            X_test = np.array(X_test, dtype='float16')
-        elif PIXELS == 299:
-            X_train -= 128
-            X_train /= 128
-            X_test -= 128
-            X_test /= 128
-        else:
-            X_test = np.array(X_test, dtype='float32')
-        X_test_id = np.array(X_test_id)
-
-        np.save('data/cache/X_test_%d_f32.npy'%PIXELS, X_test)
-        np.save('data/cache/X_test_id_%d_f32.npy'%PIXELS, X_test_id)
-
-    X_test = X_test.reshape(X_test.shape[0], 3, PIXELS, PIXELS)
-
-
-    # pixels of 224 are only used for finetuning pretrained networks so we use ImageNet channel means
-    if PIXELS == 224:
-        mean_pixel = [103.939, 116.779, 123.68]
-        for c in range(3):
-            X_test[:, c, :, :] = X_test[:, c, :, :] - mean_pixel[c]
-    else:
-        # subtract pixel mean
-        pixel_mean = np.load('data/pixel_mean_full_%d.npy'%PIXELS)
-        X_test -= pixel_mean
+def load_test(pixels, cache=False, normalization=None, grayscale=False):
+    X_test, _, X_test_id = load_dataset('test', pixels, normalization, grayscale, cache=cache)
 
     return X_test, X_test_id
 
-def load_test_efficient(cache=False, size=PIXELS, grayscale=False):
-    if grayscale:
-        mode = '_bw'
-    else:
-        mode = ''
-
-    filename = 'data/cache/X_test_%d_f32%s'%(PIXELS, mode)
-
-    if cache and os.path.exists(filename):
-        X_test = np.load(filename)
-        X_test_id = np.load('data/cache/X_test_id_f32.npy')
-    else:
-        print('Read test images')
-        path = os.path.join('data', 'imgs', 'test', '*.jpg')
-        files = glob.glob(path)
-        total_files = len(files)
-
-        X_test_id = np.empty(total_files, dtype='S14') # S14 is what numpy saves these as
-
-        # Lazy allocation
-        X_test = None
-
-        for count, fl in enumerate(files):
-            if count%100 == 0:
-                print('%d of %d'%(count, len(files)))
-
-            flbase = os.path.basename(fl)
-            img = imread(fl, as_grey = grayscale)
-            img = transform.resize(img, output_shape=(PIXELS, PIXELS, 3), preserve_range=True)
-
-            if not grayscale:
-                #img = img.transpose(2, 0, 1)
-                channels = 3
-            else:
-                channels = 1
-
-            if X_test is none:
-                X_test = np.empty((PIXELS, PIXELS, channels, total_files), dtype=np.float32)
-
-            # Removed for computation and ease of figuring out if its grayscale
-            #img = np.reshape(img, (1, num_features))
-            X_test[..., count] = transform.resize(img, output_shape=(PIXELS, PIXELS, channels), preserve_range=True)
-            X_test_id[count] = flbase
-
-        np.save(filename, X_test)
-        np.save('data/cache/X_test_id_f32.npy', X_test_id)
-
-    X_train = X_train.transpose(3, 2, 0, 1) #/ 255.
-
-    # subtract pixel mean
-    pixel_mean = np.load('data/pixel_mean_full_%d.npy'%PIXELS)
-    X_test -= pixel_mean
-
-    return X_test, X_test_id
-
-def load_pseudo(cache=True, size=PIXELS):
-    if cache:
-        X_test = np.load('data/cache/X_test_%d_f32.npy'%PIXELS)
-        pseudos = np.load('data/cache/pseudo_0175.npy')
-    else:
-        # don't know why it wouldn't already be cached
-        # if not add lines 123 to 136
-        print 'what the heck?!'
-
-    X_test = X_test.reshape(X_test.shape[0], 3, PIXELS, PIXELS)
-
-    # subtract pixel mean
-    pixel_mean = np.load('data/pixel_mean_full_%d.npy'%PIXELS)
-    X_test -= pixel_mean
-
-    return X_test, pseudos
+def load_test_efficient(pixels, cache=False, grayscale=False):
+    # the grayscale network takes 0-1 images
+    return load_test(pixels, cache, 'unit' if grayscale else None, grayscale)
 
-def plot_sample(img):
-    img = img.reshape(PIXELS, PIXELS, 3)
+def load_pseudo(pixels, cache=True, normalization=None, pseudo_file='data/cache/pseudo_0175.npy'):
+    '''
+    Test images and their soft targets. pseudo_file is a prediction store (.npz) or an old .npy,
+    and either way its rows are matched to the test images by id. The ids of a .npy are kept
+    next to it in <name>_ids.npy.
+    '''
+    X_test, _, X_test_id = load_dataset('test', pixels, normalization, cache=cache)
+    if pseudo_file.endswith('.npz'):
+        return X_test, aligned_predictions(pseudo_file, X_test_id)
+
+    pseudos = np.load(pseudo_file)
+    ids_file = os.path.splitext(pseudo_file)[0] + '_ids.npy'
+    if not os.path.isfile(ids_file):
+        # an old .npy is in the order of the old test cache, which is only known while that cache
+        # was never rebuilt: a rebuilt one has a manifest and its rows in sorted file order
+        X_filename = cache_filenames('test', pixels)[0]
+        if os.path.isfile(manifest_filename(X_filename)):
+            raise ValueError('%s has no %s and %s was rebuilt, so its rows cannot be matched to the test images; '
+                             'regenerate it as a prediction store (.npz)'%(pseudo_file, ids_file, X_filename))
+        if len(pseudos) != len(X_test_id):
+            raise ValueError('%s has %d rows for %d test images'%(pseudo_file, len(pseudos), len(X_test_id)))
+        np.save(ids_file, X_test_id)
+    return X_test, align_rows(pseudos, np.load(ids_file), X_test_id, pseudo_file)
+
+def plot_sample(img, pixels):
+    from matplotlib import pyplot
+    from skimage.io import imshow
+
+    img = img.reshape(pixels, pixels, 3)
     imshow(img)
     #img = img / 290.
     pyplot.show(block=True)
 
 def fast_warp(img, tf, output_shape, mode='reflect', cval=0.0):
+    from skimage import transform
     return transform._warps_cy._warp_fast(img, tf.params, output_shape=output_shape, mode=mode)
 
-def batch_iterator_train(data, y, BATCHSIZE, train_fn):
+def batch_iterator_train(data, y, BATCHSIZE, train_fn, aug_mode='batch'):
     '''
     Data augmentation batch iterator for feeding images into CNN.
     Pads each image with 16 pixels on every side.
@@ -284,91 +119,21 @@ def batch_iterator_train(data, y, BATCHSIZE, train_fn):
         X_batch = data[indx[sl]]
         y_batch = y[indx[sl]]
 
-        # color intensity augmentation
-        r_intensity = random.randint(0,1)
-        g_intensity = random.randint(0,1)
-        b_intensity = random.randint(0,1)
-        intensity_scaler = random.randint(-20, 20)
-
-        # pad and crop settings
-        trans_1 = random.randint(0, (PAD_CROP*2))
-        trans_2 = random.randint(0, (PAD_CROP*2))
-        crop_x1 = trans_1
-        crop_x2 = (PIXELS + trans_1)
-        crop_y1 = trans_2
-        crop_y2 = (PIXELS + trans_2)
-
-        # random zooms
-        zoom = random.uniform(0.8, 1.2)
-
-        # shearing
-        shear_deg = random.uniform(-5,5)
-
-        # random rotations betweein -15 and 15 degrees
-        dorotate = random.randint(-15,15)
-
-        # brightness settings
-        bright = random.uniform(0.9,1.1)
-
-        # flip left-right choice
-        #flip_lr = random.randint(0,1)
-
-        # flip up-down choice
-        #flip_ud = random.randint(0,1)
-
-        # set the transform parameters for skimage.transform.warp
-        # have to shift to center and then shift back after transformation otherwise
-        # rotations will make image go out of frame
-        center_shift   = np.array((PIXELS, PIXELS)) / 2. - 0.5
-        tform_center   = transform.SimilarityTransform(translation=-center_shift)
-        tform_uncenter = transform.SimilarityTransform(translation=center_shift)
-
-        tform_aug = transform.AffineTransform(shear = np.deg2rad(shear_deg),
-                                              scale = (1/zoom, 1/zoom),
-                                              rotation = np.deg2rad(dorotate))
-
-        tform = tform_center + tform_aug + tform_uncenter
-
-        # set empty copy to hold augmented images so that we don't overwrite
-        X_batch_aug = np.copy(X_batch)
-
-        # for each image in the batch do the augmentation
-        for j in range(X_batch.shape[0]):
-            # for each image channel
-            for k in range(X_batch.shape[1]):
-                X_batch_aug[j,k] = fast_warp(X_batch_aug[j,k], tform, output_shape=(PIXELS,PIXELS))
-                # pad and crop images
-                img_pad = np.pad(X_batch_aug[j,k], pad_width=((PAD_CROP,PAD_CROP), (PAD_CROP,PAD_CROP)), mode='reflect')
-                X_batch_aug[j,k] = img_pad[crop_x1:crop_x2, crop_y1:crop_y2]
-
-                # flip left-right if chosen
-                #if flip_lr == 1:
-                #    X_batch_aug[j,k] = np.fliplr(X_batch_aug[j,k])
-
-                # flip left-right if chosen
-                #if flip_ud == 1:
-                #    X_batch_aug[j,k] = np.flipud(X_batch_aug[j,k])
-
-            if r_intensity == 1:
-                X_batch_aug[j][0] += intensity_scaler
-            if g_intensity == 1:
-                X_batch_aug[j][1] += intensity_scaler
-            if b_intensity == 1:
-                X_batch_aug[j][2] += intensity_scaler
-
-            # adjust brightness
-            X_batch_aug[j] = X_batch_aug[j] * bright
+        # warp, pad-crop, intensity and brightness for the whole batch at once
+        X_batch_aug = augmentation_engine(X_batch.shape[-1], aug_mode).augment(X_batch)
 
         # fit model on each batch
         loss.append(train_fn(X_batch_aug, y_batch))
 
     return np.mean(loss)
 
-def batch_iterator_train_pseudo_label(data, y, pdata, py, BATCHSIZE, train_fn):
+def batch_iterator_train_pseudo_label(data, y, pdata, py, BATCHSIZE, train_fn, aug_mode='batch'):
     '''
     Batch iterator for training wiht pseudo soft targets
     For total batch size 32, take 22 from train, and 10 from labeled test
     '''
+    from sklearn.utils import shuffle
+
     pBATCHSIZE = int(round(BATCHSIZE * 0.33))
     BATCHSIZE -= pBATCHSIZE
     n_samples = data.shape[0]
@@ -389,70 +154,8 @@ def batch_iterator_train_pseudo_label(data, y, pdata, py, BATCHSIZE, train_fn):
         y_batch = np.vstack((y[train_indx[sl]], py[test_indx[psl]]))
         X_batch, y_batch = shuffle(X_batch, y_batch)
 
-        # color intensity augmentation
-        r_intensity = random.randint(0,1)
-        g_intensity = random.randint(0,1)
-        b_intensity = random.randint(0,1)
-        intensity_scaler = random.randint(-20, 20)
-
-        # pad and crop settings
-        trans_1 = random.randint(0, (PAD_CROP*2))
-        trans_2 = random.randint(0, (PAD_CROP*2))
-        crop_x1 = trans_1
-        crop_x2 = (PIXELS + trans_1)
-        crop_y1 = trans_2
-        crop_y2 = (PIXELS + trans_2)
-
-        # shearing
-        shear_deg = random.uniform(-5,5)
-
-        # random rotations betweein -15 and 15 degrees
-        dorotate = random.randint(-15,15)
-
-        # brightness settings
-        bright = random.uniform(0.9,1.1)
-
-        # random zooms
-        zoom = random.uniform(0.8, 1.2)
-
-        # set the transform parameters for skimage.transform.warp
-        # have to shift to center and then shift back after transformation otherwise
-        # rotations will make image go out of frame
-        center_shift   = np.array((PIXELS, PIXELS)) / 2. - 0.5
-        tform_center   = transform.SimilarityTransform(translation=-center_shift)
-        tform_uncenter = transform.SimilarityTransform(translation=center_shift)
-
-        tform_aug = transform.AffineTransform(shear = np.deg2rad(shear_deg),
-                                              scale = (1/zoom, 1/zoom),
-                                              rotation = np.deg2rad(dorotate))
-
-        tform = tform_center + tform_aug + tform_uncenter
-
-        # set empty copy to hold augmented images so that we don't overwrite
-        X_batch_aug = np.copy(X_batch)
-
-        # for each image in the batch do the augmentation
-        for j in range(X_batch.shape[0]):
-            # for each image channel
-            for k in range(X_batch.shape[1]):
-                X_batch_aug[j,k] = fast_warp(X_batch_aug[j,k], tform, output_shape=(PIXELS,PIXELS))
-                # pad and crop images
-                img_pad = np.pad(X_batch_aug[j,k], pad_width=((PAD_CROP,PAD_CROP), (PAD_CROP,PAD_CROP)), mode='reflect')
-                X_batch_aug[j,k] = img_pad[crop_x1:crop_x2, crop_y1:crop_y2]
-
-                # flip left-right if chosen
-                #if flip_lr == 1:
-                #    X_batch_aug[j,k] = np.fliplr(X_batch_aug[j,k])
-
-            if r_intensity == 1:
-                X_batch_aug[j][0] += intensity_scaler
-            if g_intensity == 1:
-                X_batch_aug[j][1] += intensity_scaler
-            if b_intensity == 1:
-                X_batch_aug[j][2] += intensity_scaler
-
-            # adjust brightness
-            X_batch_aug[j] = X_batch_aug[j] * bright
+        # warp, pad-crop, intensity and brightness for the whole batch at once
+        X_batch_aug = augmentation_engine(X_batch.shape[-1], aug_mode).augment(X_batch)
 
         # fit model on each batch
         loss.append(train_fn(X_batch_aug, y_batch))
@@ -498,9 +201,46 @@ def batch_iterator_valid(data_test, y_test, batchsize, valid_fn):
 
     return np.mean(loss_valid), np.mean(acc_valid)
 
+def batch_iterator_valid_proba(data_test, y_test, batchsize, valid_fn):
+    '''
+    Batch iterator for a valid_fn returning loss, accuracy and class probabilities in one pass.
+    Returns the loss and accuracy averaged over samples and the (samples, classes) probabilities.
+    '''
+    n_samples_valid = data_test.shape[0]
+    loss_valid = 0.
+    acc_valid = 0.
+    proba_valid = []
+    for i in range((n_samples_valid + batchsize - 1) // batchsize):
+        sl = slice(i * batchsize, (i + 1) * batchsize)
+        X_batch_test = data_test[sl]
+        y_batch_test = y_test[sl]
 
-# TODO: batch_iterator_train should also be replaced by calling this shared function
-def augment_batch(X_batch, y_batch):
+        loss_vv, acc_vv, proba_vv = valid_fn(X_batch_test, y_batch_test)
+        # weight by batch size so a short last batch does not skew the means
+        loss_valid += loss_vv * X_batch_test.shape[0]
+        acc_valid += acc_vv * X_batch_test.shape[0]
+        proba_valid.append(proba_vv)
+
+    return loss_valid / n_samples_valid, acc_valid / n_samples_valid, np.vstack(proba_valid)
+
+def auto_batchsize(fn, data, y, start, limit=512):
+    '''
+    Largest of start, 2*start, 4*start ... up to limit and len(data) that fn(data, y) runs on
+    without running out of host or device memory, found by trying each size once.
+    '''
+    batchsize = start
+    while batchsize * 2 <= min(limit, data.shape[0]):
+        try:
+            fn(data[:batchsize * 2], y[:batchsize * 2])
+        except Exception as e:
+            # theano raises MemoryError, the gpuarray backend a GpuArrayException saying out of memory
+            if not isinstance(e, MemoryError) and 'memory' not in str(e).lower():
+                raise
+            break
+        batchsize *= 2
+    return batchsize
+
+def augment_batch(X_batch, y_batch, aug_mode='batch'):
     '''
     Data augmentation batch iterator for feeding images into CNN.
     Pads each image with 16 pixels on every side.
@@ -510,92 +250,143 @@ def augment_batch(X_batch, y_batch):
     Random shears -5 to 5 degrees
     Random rotations -15 to 15 degrees
     '''
+    return augmentation_engine(X_batch.shape[-1], aug_mode).augment(X_batch), y_batch
 
-    # color intensity augmentation
-    r_intensity = random.randint(0,1)
-    g_intensity = random.randint(0,1)
-    b_intensity = random.randint(0,1)
-    intensity_scaler = random.randint(-20, 20)
-
-    # pad and crop settings
-    trans_1 = random.randint(0, (PAD_CROP*2))
-    trans_2 = random.randint(0, (PAD_CROP*2))
-    crop_x1 = trans_1
-    crop_x2 = (PIXELS + trans_1)
-    crop_y1 = trans_2
-    crop_y2 = (PIXELS + trans_2)
-
-    # random zooms
-    zoom = random.uniform(0.8, 1.2)
-
-    # shearing
-    shear_deg = random.uniform(-5,5)
-
-    # random rotations betweein -15 and 15 degrees
-    dorotate = random.randint(-15,15)
-
-    # brightness settings
-    bright = random.uniform(0.9,1.1)
+# state shared with the loader worker processes, filled in before the pool forks
+_LOADER_STATE = {}
 
-    # flip left-right choice
-    #flip_lr = random.randint(0,1)
+def _loader_init(seed):
+    # every worker gets its own global numpy/random streams for anything not using the batch rng
+    worker_id = multiprocessing.current_process()._identity[0]
+    np.random.seed([seed, worker_id])
+    random.seed((seed, worker_id))
 
-    # flip up-down choice
-    #flip_ud = random.randint(0,1)
-
-    # set the transform parameters for skimage.transform.warp
-    # have to shift to center and then shift back after transformation otherwise
-    # rotations will make image go out of frame
-    center_shift   = np.array((PIXELS, PIXELS)) / 2. - 0.5
-    tform_center   = transform.SimilarityTransform(translation=-center_shift)
-    tform_uncenter = transform.SimilarityTransform(translation=center_shift)
-
-    tform_aug = transform.AffineTransform(shear = np.deg2rad(shear_deg),
-                                          scale = (1/zoom, 1/zoom),
-                                          rotation = np.deg2rad(dorotate))
-
-    tform = tform_center + tform_aug + tform_uncenter
-
-    # set empty copy to hold augmented images so that we don't overwrite
-    X_batch_aug = np.copy(X_batch)
+def _loader_batch(task):
+    '''
+    Build and augment one batch inside a loader worker.
+    The rng is seeded from (seed, epoch, batch) so a batch is identical no matter which worker builds it.
+    '''
+    seed, epoch, i, indx, pindx = task
+    rng = np.random.RandomState([seed, epoch, i])
+    data = _LOADER_STATE['data']
+    y = _LOADER_STATE['y']
+
+    if pindx is None:
+        X_batch = data[indx]
+        y_batch = y[indx]
+    else:
+        X_batch = np.vstack((data[indx], _LOADER_STATE['pdata'][pindx]))
+        y_batch = np.vstack((y[indx], _LOADER_STATE['py'][pindx]))
+        shuffle_indx = rng.permutation(X_batch.shape[0])
+        X_batch, y_batch = X_batch[shuffle_indx], y_batch[shuffle_indx]
 
-    # for each image in the batch do the augmentation
-    for j in range(X_batch.shape[0]):
-        # for each image channel
-        for k in range(X_batch.shape[1]):
-            X_batch_aug[j,k] = fast_warp(X_batch_aug[j,k], tform, output_shape=(PIXELS,PIXELS))
-            # pad and crop images
-            img_pad = np.pad(X_batch_aug[j,k], pad_width=((PAD_CROP,PAD_CROP), (PAD_CROP,PAD_CROP)), mode='reflect')
-            X_batch_aug[j,k] = img_pad[crop_x1:crop_x2, crop_y1:crop_y2]
+    return augmentation_engine(X_batch.shape[-1], _LOADER_STATE['aug_mode']).augment(X_batch, rng), y_batch
 
-            # flip left-right if chosen
-            #if flip_lr == 1:
-            #    X_batch_aug[j,k] = np.fliplr(X_batch_aug[j,k])
+class PrefetchLoader(object):
+    '''
+    Background loader for the training loops.
+    Augmented batches are built in a pool of worker processes while train_fn runs, with at most
+    queue_size finished batches waiting at any time. workers=0 builds batches in the training process.
 
-            # flip left-right if chosen
-            #if flip_ud == 1:
-            #    X_batch_aug[j,k] = np.flipud(X_batch_aug[j,k])
+    If pdata and py are given, each batch mixes train and pseudo labeled test samples the same way
+    batch_iterator_train_pseudo_label does. aug_mode is the AugmentationEngine mode, 'batch' or 'sample'.
+    '''
+    def __init__(self, data, y, batchsize, pdata=None, py=None, workers=2, queue_size=8, seed=0, aug_mode='batch'):
+        self.n_samples = data.shape[0]
+        self.n_pseudo = 0 if pdata is None else pdata.shape[0]
+        self.batchsize = batchsize
+        self.pbatchsize = 0
+        if pdata is not None:
+            self.pbatchsize = int(round(batchsize * 0.33))
+            self.batchsize -= self.pbatchsize
+        self.queue_size = max(queue_size, 1)
+        self.seed = seed
+
+        _LOADER_STATE.update(data=data, y=y, pdata=pdata, py=py, aug_mode=aug_mode)
+        self.pool = None
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers, initializer=_loader_init, initargs=(seed,))
+
+    def tasks(self, epoch):
+        rng = np.random.RandomState([self.seed, epoch])
+        indx = rng.permutation(self.n_samples)
+        if self.pbatchsize:
+            pindx = rng.permutation(self.n_pseudo)
+        for i in range((self.n_samples + self.batchsize - 1) // self.batchsize):
+            sl = slice(i * self.batchsize, (i + 1) * self.batchsize)
+            psl = slice(i * self.pbatchsize, (i + 1) * self.pbatchsize)
+            yield (self.seed, epoch, i, indx[sl], pindx[psl] if self.pbatchsize else None)
+
+    def epoch(self, epoch):
+        '''
+        Yield the augmented (X_batch, y_batch) pairs for one epoch in order,
+        and print how long the training loop waited for data.
+        '''
+        start = time.time()
+        wait = 0.
+        n_batches = 0
+
+        if self.pool is None:
+            for task in self.tasks(epoch):
+                t = time.time()
+                batch = _loader_batch(task)
+                wait += time.time() - t
+                n_batches += 1
+                yield batch
+        else:
+            pending = deque()
+            tasks = self.tasks(epoch)
+            for task in tasks:
+                pending.append(self.pool.apply_async(_loader_batch, (task,)))
+                if len(pending) >= self.queue_size:
+                    break
+            while pending:
+                t = time.time()
+                batch = pending.popleft().get()
+                wait += time.time() - t
+                for task in tasks:
+                    pending.append(self.pool.apply_async(_loader_batch, (task,)))
+                    break
+                n_batches += 1
+                yield batch
+
+        total = time.time() - start
+        print('loader: epoch %d | batches %d | data wait %.1fs of %.1fs (%.1f%%)'%(
+              epoch, n_batches, wait, total, 100. * wait / max(total, 1e-8)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+def batch_iterator_train_prefetch(loader, epoch, train_fn):
+    '''
+    Training batch iterator fed by a PrefetchLoader, so augmentation overlaps with train_fn.
+    '''
+    loss = []
+    for X_batch_aug, y_batch in loader.epoch(epoch):
+        # fit model on each batch
+        loss.append(train_fn(X_batch_aug, y_batch))
 
-        if r_intensity == 1:
-            X_batch_aug[j][0] += intensity_scaler
-        if g_intensity == 1:
-            X_batch_aug[j][1] += intensity_scaler
-        if b_intensity == 1:
-            X_batch_aug[j][2] += intensity_scaler
+    return np.mean(loss)
 
-        # adjust brightness
-        X_batch_aug[j] = X_batch_aug[j] * bright
 
-        return X_batch_aug, y_batch
+def batch_augmentor_class():
+    '''
+    keras ImageDataGenerator whose batches go through augment_batch. Defined on demand so
+    importing utils does not import keras.
+    '''
+    from keras.preprocessing.image import ImageDataGenerator
 
-from keras.preprocessing.image import ImageDataGenerator
+    class BatchAugmentor(ImageDataGenerator):
+        def next(self):
+            with self.lock:
+                index_array, current_index, current_batch_size = next(self.flow_generator)
 
-class BatchAugmentor(ImageDataGenerator):
-    def next(self):
-        with self.lock:
-            index_array, current_index, current_batch_size = next(self.flow_generator)
+            X_batch = self.X[index_array]
+            y_batch = self.y[index_array]
 
-        X_batch = self.X[index_array]
-        y_batch = self.y[index_array]
+            return augment_batch(X_batch, y_batch)
 
-        return augment_batch(X_batch, y_batch)
+    return BatchAugmentor
@@ -0,0 +1,192 @@
+import os
+import sys
+import gzip
+import json
+import struct
+import cPickle as pickle
+from collections import OrderedDict
+import numpy as np
+
+'''
+Fast weight files.
+
+Trained weights used to be a gzip pickled list of arrays, which the submission scripts
+decompress and unpickle in full before predicting. A .weights file is uncompressed instead:
+
+    MAGIC | header length (uint64) | json header | arrays, each at a 64 byte boundary
+
+The header lists name, shape, dtype and offset of every parameter in the order of
+lasagne's get_all_params, names like 012.Conv2DLayer.W (layer index, layer class, param
+name). read_params memory-maps each array, so opening a file costs nothing and only the
+pages set_value copies are read.
+
+load_params matches parameters by position, like set_all_param_values, because the
+submission scripts load weights into networks built by other functions; the names are
+only used in messages. Shapes are always checked, and the params of skip_layers (e.g. a
+new 10-way DenseLayer) keep their values. Old .pklz files are still read when no .weights
+file exists:
+
+    python weightstore.py data/weights/*.pklz    # convert
+
+The pickled pretrained models the finetune scripts start from are converted the first time
+pretrained_weights is asked for them.
+'''
+
+MAGIC = 'LSGNWTS1'
+ALIGN = 64
+WEIGHT_DIR = os.path.join('data', 'weights')
+
+def weights_filename(label, kind):
+    '''
+    data/weights/<label>_<kind>.weights, kind best or last.
+    '''
+    return os.path.join(WEIGHT_DIR, '%s_%s.weights'%(label, kind))
+
+def named_params(output_layer):
+    '''
+    The params of get_all_params(output_layer), in its order, and their names.
+    '''
+    from lasagne.layers import helper
+
+    params, names = [], []
+    for idx, layer in enumerate(helper.get_all_layers(output_layer)):
+        for p in layer.get_params():
+            if p not in params:
+                params.append(p)
+                names.append('%03d.%s.%s'%(idx, layer.__class__.__name__, p.name))
+    return params, names
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+def write_weights(filename, names, values):
+    '''
+    Write arrays values under names to a .weights file.
+    '''
+    values = [np.ascontiguousarray(v) for v in values]
+    entries = [{'name': name, 'shape': list(v.shape), 'dtype': v.dtype.str} for name, v in zip(names, values)]
+
+    # offsets depend on the header length, which depends on the offsets' digits, so pad the header generously
+    header_len = _aligned(len(json.dumps(entries)) + 32 * len(entries) + 64)
+    offset = _aligned(len(MAGIC) + 8 + header_len)
+    for entry, v in zip(entries, values):
+        entry['offset'] = offset
+        offset = _aligned(offset + v.nbytes)
+    header = json.dumps(entries)
+    header += ' ' * (header_len - len(header))
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # write then rename so a reader never sees a half written file
+    tmp_filename = '%s.%d.tmp'%(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', header_len))
+        f.write(header)
+        for entry, v in zip(entries, values):
+            f.seek(entry['offset'])
+            f.write(v.tobytes())
+        f.truncate(offset)
+    os.rename(tmp_filename, filename)
+
+def save_params(output_layer, filename, values=None):
+    '''
+    Save the params of output_layer, or values in their order (e.g. the best epoch's).
+    '''
+    params, names = named_params(output_layer)
+    if values is None:
+        values = [p.get_value() for p in params]
+    if len(values) != len(params):
+        raise ValueError('%d values for the %d params of the network'%(len(values), len(params)))
+    write_weights(filename, names, values)
+
+def read_params(filename):
+    '''
+    OrderedDict of name to read-only memory-mapped array of a .weights file.
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a weights file'%filename)
+        header_len, = struct.unpack('<Q', f.read(8))
+        entries = json.loads(f.read(header_len))
+
+    params = OrderedDict()
+    for entry in entries:
+        shape = tuple(entry['shape'])
+        if np.prod(shape) == 0:
+            # mmap cannot map zero bytes
+            params[entry['name']] = np.empty(shape, dtype=entry['dtype'])
+        else:
+            params[entry['name']] = np.memmap(filename, dtype=entry['dtype'], mode='r', offset=entry['offset'], shape=shape)
+    return params
+
+def read_legacy(filename):
+    '''
+    Values of a gzip pickled list of arrays, or of a pickled dict with 'param values'.
+    '''
+    opener = gzip.open if filename.endswith('.pklz') else open
+    with opener(filename, 'rb') as f:
+        values = pickle.load(f)
+    if isinstance(values, dict):
+        values = values['param values']
+    return OrderedDict(('%03d'%i, v) for i, v in enumerate(values))
+
+def load_params(output_layer, filename, skip_layers=(), strict=True):
+    '''
+    Set the params of output_layer from filename, by position, except those of skip_layers.
+    A missing .weights file falls back to the .pklz of the same name. With strict=False params
+    the file has no value of the right shape for are left as they are instead of raising.
+    Returns the number of params set.
+    '''
+    if filename.endswith('.weights') and not os.path.isfile(filename):
+        legacy = filename[:-len('.weights')] + '.pklz'
+        if os.path.isfile(legacy):
+            filename = legacy
+    stored = read_params(filename) if filename.endswith('.weights') else read_legacy(filename)
+    stored_names, stored_values = stored.keys(), stored.values()
+
+    params, names = named_params(output_layer)
+    skip = set(p for layer in skip_layers for p in layer.get_params())
+    if strict and not skip and len(stored_values) != len(params):
+        raise ValueError('%s has %d params, the network %d'%(filename, len(stored_values), len(params)))
+
+    count = 0
+    for i, (p, name) in enumerate(zip(params, names)):
+        if p in skip:
+            continue
+        shape = p.get_value(borrow=True).shape
+        if i >= len(stored_values) or stored_values[i].shape != shape:
+            if strict:
+                raise ValueError('%s: no value of shape %s for %s, found %s'%(filename, shape, name,
+                                 stored_names[i] + ' ' + str(stored_values[i].shape) if i < len(stored_values) else 'none'))
+            print('load_params: %s keeps its value'%name)
+            continue
+        p.set_value(np.asarray(stored_values[i], dtype=p.dtype))
+        count += 1
+    return count
+
+def convert_legacy(filename):
+    '''
+    Write the values of a pickled weights file to a .weights file next to it and return its name.
+    Names are positional since the network is unknown here.
+    '''
+    stored = read_legacy(filename)
+    out = os.path.splitext(filename)[0] + '.weights'
+    write_weights(out, stored.keys(), stored.values())
+    print('%s -> %s'%(filename, out))
+    return out
+
+def pretrained_weights(filename):
+    '''
+    The .weights file of a pickled pretrained model, converted from it the first time.
+    '''
+    out = os.path.splitext(filename)[0] + '.weights'
+    if os.path.isfile(out):
+        return out
+    return convert_legacy(filename)
+
+if __name__ == '__main__':
+    # convert old gzip pickled weights
+    for filename in sys.argv[1:]:
+        convert_legacy(filename)